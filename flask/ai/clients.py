@@ -0,0 +1,55 @@
+from requests.adapters import HTTPAdapter
+import os
+import threading
+import requests
+
+# Connection pool sizing and timeouts (seconds) for image downloads
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 32))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+
+# Per-attempt timeout for Gemini calls (seconds); retries are handled by services.upstream
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 60))
+
+_lock = threading.Lock()
+_gemini_client = None
+_http_session = None
+
+
+def get_gemini_client():
+    """Return the process-wide Gemini client, creating it (and importing the SDK) on first use."""
+    global _gemini_client
+    if _gemini_client is None:
+        with _lock:
+            if _gemini_client is None:
+                from google import genai
+                _gemini_client = genai.Client(
+                    api_key=os.getenv("GEMINI_KEY"),
+                    http_options={"timeout": int(GEMINI_TIMEOUT * 1000)})
+    return _gemini_client
+
+
+def set_gemini_client(client):
+    """Replace the process-wide Gemini client, e.g. with a local stand-in for benchmarks."""
+    global _gemini_client
+    with _lock:
+        _gemini_client = client
+
+
+def get_http_session():
+    """Return the process-wide requests session, which keeps connections alive between downloads."""
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+
+def get_http_timeout():
+    return HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
@@ -0,0 +1,82 @@
+import io
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Set NEAR_DUPLICATES=1 to reuse analyses of visually near-identical earlier images
+NEAR_DUPLICATES = os.getenv("NEAR_DUPLICATES", "0").lower() in ("1", "true", "yes")
+# Largest Hamming distance (out of 64 bits) between two hashes still treated as the same tray
+NEAR_DUPLICATE_THRESHOLD = int(os.getenv("NEAR_DUPLICATE_THRESHOLD", 6))
+# Reuse the earlier volumes as well as the food list, skipping the model entirely
+NEAR_DUPLICATE_REUSE_VOLUMES = os.getenv("NEAR_DUPLICATE_REUSE_VOLUMES", "0").lower() in ("1", "true", "yes")
+NEAR_DUPLICATE_INDEX_SIZE = int(os.getenv("NEAR_DUPLICATE_INDEX_SIZE", 5000))
+
+HASH_SIZE = 8
+
+
+def dhash(data):
+    """
+    Compute a 64-bit difference hash of an image: the sign of the horizontal gradient
+    on a 9x8 grayscale thumbnail. Returns None if Pillow is unavailable or the image
+    cannot be decoded.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Let the JPEG decoder skip most of the pixels we are about to throw away
+            image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+            image = ImageOps.exif_transpose(image)
+            pixels = list(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning(f"Could not compute perceptual hash: {str(e)}")
+        return None
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class NearDuplicateIndex:
+    """
+    Bounded index of perceptual hashes of analysed images and their results,
+    searched by Hamming distance. The oldest entries are dropped first.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find(self, image_hash, threshold):
+        """Return (distance, result) for the closest indexed image within threshold, or None."""
+        with self.lock:
+            candidates = list(self.entries.items())
+        best = None
+        for other_hash, result in candidates:
+            distance = (image_hash ^ other_hash).bit_count()
+            if distance <= threshold and (best is None or distance < best[0]):
+                best = (distance, result)
+                if distance == 0:
+                    break
+        return best
+
+    def add(self, image_hash, result):
+        with self.lock:
+            self.entries[image_hash] = result
+            self.entries.move_to_end(image_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+near_duplicate_index = NearDuplicateIndex(NEAR_DUPLICATE_INDEX_SIZE)
@@ -1,102 +1,322 @@
-from google import genai
-from dotenv import load_dotenv
 import os
 import re
 import requests
 import json
-
-from . import utils
+import logging
+import time
+import threading
+import numpy as np
+
+from services import density_service, metrics, upstream
+from . import clients, utils
+from .result_cache import result_cache, make_key
+from . import near_duplicates
+
+logger = logging.getLogger(__name__)
+
+# Set PREDICT_MODE=fused to identify foods and volumes in a single model call by default
+FUSED_DEFAULT = os.getenv("PREDICT_MODE", "two_step") == "fused"
+
+MODEL = "gemini-2.0-flash"
+
+FOODS_PROMPT = ("You are given an image of some food that may be uneaten or partially eaten. "
+                "Your task is to figure out all the different foods in the image and name them in JSON format. "
+                "The JSON should have one key called 'foods' that holds an array of food names (strings). "
+                "Show your thought process, and when you're done, wrap the JSON output in a JSON html tag. For parsing purposes, only include the JSON html tag in your response when you are returning the JSON."
+                "To figure out the foods, follow these steps:\n"
+                "1. Isolate the foods if multiple foods exist in the image."
+                "2. Use your knowledge base to categorize each food\n"
+                "Here is an example JSON response that I expect from you: \n"
+                "<json>{foods: ['apple', 'orange', 'chicken']}</json>")
+
+VOLUME_PROMPT = ("You are given an image of some food that may be uneaten or partially eaten. "
+                 "Your task is to figure out the volume of the foods (in Liters) in the image. "
+                 "The foods in the images are: %s\n\n"
+                 "Rules to follow in your response:\n"
+                 "1. Show your thought process\n"
+                 "2. After showing your thought process, format your response in JSON. Wrap this JSON in a ‘json’ html tag so that "
+                 "I can parse it easily. Your JSON response should have a key for each food and "
+                 "the value of each key should be the volume of that food (as a float).\n\n"
+                 "Format your response like this:\n"
+                 "<json>{\"rice\": 0.25, \"fried tofu\": 0.33, \"fried garlic\": 0.03}</json>")
+
+FUSED_PROMPT = ("You are given an image of some food that may be uneaten or partially eaten. "
+                "Your task is to figure out all the different foods in the image and the volume of each food (in Liters).\n\n"
+                "To figure out the foods, follow these steps:\n"
+                "1. Isolate the foods if multiple foods exist in the image.\n"
+                "2. Use your knowledge base to categorize each food\n"
+                "3. Estimate the volume of each food\n\n"
+                "Rules to follow in your response:\n"
+                "1. Show your thought process\n"
+                "2. After showing your thought process, format your response in JSON. Wrap this JSON in a ‘json’ html tag so that "
+                "I can parse it easily. Your JSON response should have a key for each food and "
+                "the value of each key should be the volume of that food (as a float).\n\n"
+                "Format your response like this:\n"
+                "<json>{\"rice\": 0.25, \"fried tofu\": 0.33, \"fried garlic\": 0.03}</json>")
+
+DESCRIPTION_PROMPT = ("You are given an image of some food. Your goal is to analyze the food contents and "
+                      "create a suitable name for the dish as well as a brief description of the dish. In the"
+                      " description, include details, like a percentage, about how much of the dish has been "
+                      "wasted.\n\n"
+                      "Rules to follow in your response:\n"
+                      "1. Show your thought process\n"
+                      "2. After showing your thought process, format your response in JSON. "
+                      "Wrap this JSON in a ‘json’ html tag so that I can parse it easily. "
+                      "Your JSON response should have two keys. One key called ‘name’ with the name of "
+                      "the dish as the value and one key called ‘description’ with the description of "
+                      "the dish as the value.\n\n"
+                      "Format your JSON response like this:\n"
+                      "<json>{\”name\”: \“Dish name\”, \”description\”: \“Dish description\”}</json>")
 
 
 class Predictor:
 
     client = None
     image_path = None
-
-    def __init__(self, image_path):
-        load_dotenv()
-        self.client = genai.Client(api_key=os.getenv("GEMINI_KEY"))
+    file = None
+    image_data = None
+    image_hash = None
+    image_stats = None
+    near_duplicate = None
+    fused = False
+    stream = False
+
+    def __init__(self, image_path, fused=None, stream=False):
+        self.client = clients.get_gemini_client()
         self.image_path = image_path
+        self.fused = FUSED_DEFAULT if fused is None else bool(fused)
+        self.stream = stream
+        self.lock = threading.RLock()
+        # Names of the stages whose results were served from the result cache
+        self.cached = set()
+
+    def get_image(self):
+        # Download the image once; its content hash keys both the upload and result caches
+        with self.lock:
+            if self.image_data is None:
+                self.image_data = utils.download_file_from_url(self.image_path)
+                self.image_hash = utils.hash_bytes(self.image_data)
+            return self.image_data
+
+    def get_file(self):
+        # Upload the image once, then reuse the handle for every stage (stages may run concurrently)
+        with self.lock:
+            if self.file is None:
+                data = self.get_image()
+                self.file, self.image_stats = utils.upload_bytes_to_gemini(data, self.client, self.image_hash)
+                logger.info(f"Image {self.image_path}: {self.image_stats['original_bytes']} bytes, "
+                            f"uploaded {self.image_stats['uploaded_bytes']} ({self.image_stats['bytes_saved']} saved)")
+            return self.file
+
+    def generate(self, contents, stage):
+        """
+        Run a Gemini generation and return its text. When streaming, stop reading as soon
+        as the closing </json> tag arrives, since everything after it is discarded anyway.
+        Latency and token usage are recorded under the given stage name.
+        """
+        with metrics.timed("generate", prompt=stage):
+            return upstream.gemini.call(lambda: self.generate_once(contents, stage))
+
+    def generate_once(self, contents, stage):
+        # A single upstream attempt; retries and hedges each record their own usage
+        if not self.stream:
+            response = self.client.models.generate_content(
+                model=MODEL,
+                contents=contents)
+            self.record_usage(stage, response)
+            return response.text
+
+        text = ""
+        last_chunk = None
+        chunks = self.client.models.generate_content_stream(
+            model=MODEL,
+            contents=contents)
+        try:
+            for chunk in chunks:
+                last_chunk = chunk
+                text += chunk.text or ""
+                if "</json>" in text:
+                    break
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        self.record_usage(stage, last_chunk)
+        return text
+
+    def record_usage(self, stage, response):
+        usage = getattr(response, "usage_metadata", None)
+        metrics.record_tokens(
+            "gemini", stage,
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None))
 
     def get_foods(self):
-        file = utils.upload_file_to_gemini(self.image_path, self.client)
-        prompt = ("You are given an image of some food that may be uneaten or partially eaten. "
-                  "Your task is to figure out all the different foods in the image and name them in JSON format. "
-                  "The JSON should have one key called 'foods' that holds an array of food names (strings). "
-                  "Show your thought process, and when you're done, wrap the JSON output in a JSON html tag. For parsing purposes, only include the JSON html tag in your response when you are returning the JSON."
-                  "To figure out the foods, follow these steps:\n"
-                  "1. Isolate the foods if multiple foods exist in the image."
-                  "2. Use your knowledge base to categorize each food\n"
-                  "Here is an example JSON response that I expect from you: \n"
-                  "<json>{foods: ['apple', 'orange', 'chicken']}</json>")
-        response = self.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt, file])
-        foods = self.parse_food_json(response.text)
+        file = self.get_file()
+        text = self.generate([FOODS_PROMPT, file], "foods")
+        with metrics.timed("parse", prompt="foods"):
+            foods = self.parse_food_json(text)
         return foods
 
     def get_volume(self, foods):
-        file = utils.upload_file_to_gemini(self.image_path, self.client)
-        prompt2 = ("You are given an image of some food that may be uneaten or partially eaten. "
-                   "Your task is to figure out the volume of the foods (in Liters) in the image. "
-                   "The foods in the images are: " + foods + "\n\n"
-                   "Rules to follow in your response:\n"
-                   "1. Show your thought process\n"
-                   "2. After showing your thought process, format your response in JSON. Wrap this JSON in a ‘json’ html tag so that "
-                   "I can parse it easily. Your JSON response should have a key for each food and "
-                   "the value of each key should be the volume of that food (as a float).\n\n"
-                   "Format your response like this:\n"
-                   "<json>{\"rice\": 0.25, \"fried tofu\": 0.33, \"fried garlic\": 0.03}</json>")
-        response = self.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt2, file])
-        # print("VOLUME RESPONSE")
-        # print(response.text)
-        map = self.parse_volume_json(response.text)
-        return response.text, map
-
-    def get_weight(self, food_map):
-        prompt2 = ("You are given this JSON string representing a dish where each key is a food and its value is its volume:\n\n"
-                   f"{food_map}\n\n"
-                   "Given the volume of the food, find its density by multiplying it, "
-                   "mathematically not programmatically, by its volume"
-                   " (volume is given in the JSON string in Liters) to get the weight of the food.\n\n"
-                   "Rules to follow in your response:\n"
-                   "1. Show your thought process\n"
-                   "2. After showing your thought process, format your response in JSON. Wrap this JSON in a ‘json’ html tag so that "
-                   "I can parse it easily. Your JSON response should have a key for each food and"
-                   " the value of each key should be the weight (as a float in grams)\n\n"
-                   "Format your JSON response like this:\n"
-                   "<json>{\"rice\": 100, \"fried tofu\": 120, \"fried garlic\": 80}</json>")
-        response = self.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt2])
-        # print("WEIGHT RESPONSE")
-        # print(response.text)
-        map = self.parse_volume_json(response.text)
-        return response.text, map
+        file = self.get_file()
+        text = self.generate([VOLUME_PROMPT % foods, file], "volumes")
+        with metrics.timed("parse", prompt="volumes"):
+            map = self.parse_volume_json(text)
+        return text, map
+
+    def get_foods_and_volumes(self):
+        file = self.get_file()
+        text = self.generate([FUSED_PROMPT, file], "fused")
+        with metrics.timed("parse", prompt="fused"):
+            map = self.parse_volume_json(text)
+        foods = ', '.join(map.keys())
+        return foods, text, map
+
+    def predict_volumes(self, on_foods=None):
+        """
+        Identify the foods and their volumes, in one call when fused and in two otherwise.
+        Falls back to the two-step path if the fused response fails validation.
+        Results are cached by image content, model and prompts.
+        on_foods, if given, is called with the foods as soon as they are known.
+        Returns a tuple of (foods, volume map, mode).
+        """
+        prompts = (FUSED_PROMPT, FOODS_PROMPT, VOLUME_PROMPT) if self.fused else (FOODS_PROMPT, VOLUME_PROMPT)
+        self.get_image()
+        key = make_key(self.image_hash, MODEL, *prompts)
+        cached = result_cache.get(key)
+        if cached is not None:
+            self.cached.add("volumes")
+            if on_foods:
+                on_foods(cached["foods"])
+            return cached["foods"], cached["volumes"], cached["mode"]
+
+        perceptual_hash = near_duplicates.dhash(self.image_data) if near_duplicates.NEAR_DUPLICATES else None
+        if perceptual_hash is not None:
+            reused = self.reuse_near_duplicate(perceptual_hash, on_foods)
+            if reused is not None:
+                return reused
+
+        foods, map, mode = self.run_volume_prediction(on_foods)
+        result_cache.set(key, {"foods": foods, "volumes": map, "mode": mode})
+        if perceptual_hash is not None:
+            near_duplicates.near_duplicate_index.add(
+                perceptual_hash, {"foods": foods, "volumes": map, "mode": mode, "image": self.image_path})
+        return foods, map, mode
+
+    def reuse_near_duplicate(self, perceptual_hash, on_foods=None):
+        """
+        Reuse the analysis of a visually near-identical earlier image: its volumes when
+        NEAR_DUPLICATE_REUSE_VOLUMES is set, otherwise its food list as input to get_volume.
+        Returns a tuple of (foods, volume map, mode), or None if there is no close match.
+        """
+        with metrics.timed("near_duplicate_lookup"):
+            match = near_duplicates.near_duplicate_index.find(perceptual_hash, near_duplicates.NEAR_DUPLICATE_THRESHOLD)
+        metrics.record_cache_lookup("near_duplicate", match is not None)
+        if match is None:
+            return None
+        distance, prior = match
+        # The prior image's URL belongs to another request, so it only goes to the server log
+        self.near_duplicate = {"distance": distance}
+        if on_foods:
+            on_foods(prior["foods"])
+
+        if near_duplicates.NEAR_DUPLICATE_REUSE_VOLUMES:
+            self.near_duplicate["reused"] = "volumes"
+            logger.info(f"Reusing volumes of near-duplicate {prior['image']} (distance {distance}) for {self.image_path}")
+            return prior["foods"], prior["volumes"], prior["mode"]
+
+        self.near_duplicate["reused"] = "foods"
+        logger.info(f"Reusing foods of near-duplicate {prior['image']} (distance {distance}) for {self.image_path}")
+        start = time.perf_counter()
+        _, map = self.get_volume(prior["foods"])
+        self.log_volume_prediction("near_duplicate", start, map)
+        return prior["foods"], map, "two_step"
+
+    def run_volume_prediction(self, on_foods=None):
+        if self.fused:
+            start = time.perf_counter()
+            try:
+                foods, _, map = self.get_foods_and_volumes()
+                self.log_volume_prediction("fused", start, map)
+                if on_foods:
+                    on_foods(foods)
+                return foods, map, "fused"
+            except ValueError as e:
+                logger.warning(f"Fused prediction failed validation, falling back to two-step: {e}")
+
+        start = time.perf_counter()
+        foods = self.get_foods()
+        if on_foods:
+            on_foods(foods)
+        _, map = self.get_volume(foods)
+        self.log_volume_prediction("two_step", start, map)
+        return foods, map, "two_step"
+
+    def log_volume_prediction(self, mode, start, map):
+        # One line per prediction with the same fields in both modes, so they can be compared offline
+        logger.info(json.dumps({
+            "event": "volume_prediction",
+            "mode": mode,
+            "image": self.image_path,
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+            "volumes": map
+        }))
+
+    def get_weight(self, food_map, densities=None):
+        # Weight is volume (liters) times density (g/ml), computed locally from the density service.
+        # A densities dict shared between predictors (e.g. across a batch) is filled in and reused.
+        foods = list(food_map.keys())
+        if densities is None:
+            densities = {}
+        missing = [food for food in foods if food not in densities]
+        if missing:
+            with metrics.timed("densities"):
+                densities.update(density_service.get_densities(missing))
+
+        # Foods without a usable density (API error, open circuit, "0.000" answer) get no weight
+        # and an "unresolved" source rather than a made-up 0 g
+        resolved = [bool(densities[food]['density']) for food in foods]
+        with metrics.timed("weight"):
+            volumes = np.array([food_map[food] for food in foods], dtype=float)
+            density_values = np.array([densities[food]['density'] if ok else np.nan
+                                       for food, ok in zip(foods, resolved)], dtype=float)
+            grams = volumes * 1000.0 * density_values
+
+        map = {food: round(float(weight), 2) if ok else None for food, weight, ok in zip(foods, grams, resolved)}
+        sources = {food: densities[food]['source'] if ok else 'unresolved' for food, ok in zip(foods, resolved)}
+        return sources, map
+
+    def predict(self, densities=None):
+        """
+        Run the full foods -> volumes -> weights pipeline.
+        Returns the /predict response body (without timestamp).
+        """
+        food_prediction, map, mode = self.predict_volumes()
+        sources, map = self.get_weight(map, densities)
+        return {
+            'response': map,
+            'sources': sources,
+            'mode': mode,
+            'image_stats': self.image_stats,
+            'cached': 'volumes' in self.cached,
+            'near_duplicate': self.near_duplicate
+        }
 
     def get_description(self):
-        file = utils.upload_file_to_gemini(self.image_path, self.client)
-        prompt = ("You are given an image of some food. Your goal is to analyze the food contents and "
-                  "create a suitable name for the dish as well as a brief description of the dish. In the"
-                  " description, include details, like a percentage, about how much of the dish has been "
-                  "wasted.\n\n"
-                  "Rules to follow in your response:\n"
-                  "1. Show your thought process\n"
-                  "2. After showing your thought process, format your response in JSON. "
-                  "Wrap this JSON in a ‘json’ html tag so that I can parse it easily. "
-                  "Your JSON response should have two keys. One key called ‘name’ with the name of "
-                  "the dish as the value and one key called ‘description’ with the description of "
-                  "the dish as the value.\n\n"
-                  "Format your JSON response like this:\n"
-                  "<json>{\”name\”: \“Dish name\”, \”description\”: \“Dish description\”}</json>")
-
-        response = self.client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[prompt, file])
-
-        map = self.parse_description_json(response.text)
+        self.get_image()
+        key = make_key(self.image_hash, MODEL, DESCRIPTION_PROMPT)
+        cached = result_cache.get(key)
+        if cached is not None:
+            self.cached.add("description")
+            return cached
+
+        file = self.get_file()
+        text = self.generate([DESCRIPTION_PROMPT, file], "description")
+
+        with metrics.timed("parse", prompt="description"):
+            map = self.parse_description_json(text)
+        if map is not None:
+            result_cache.set(key, map)
 
         return map
 
@@ -0,0 +1,65 @@
+import io
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Set IMAGE_PREPROCESS=0 to upload images exactly as downloaded
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1").lower() not in ("0", "false", "no")
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", 1536))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def preprocess_image(data, mime_type):
+    """
+    Rotate an image according to its EXIF orientation, downscale it to IMAGE_MAX_EDGE
+    and recompress it as IMAGE_FORMAT at IMAGE_QUALITY.
+    Returns a tuple of (data, mime_type, stats). The original bytes are returned when
+    preprocessing is disabled, Pillow is unavailable or cannot decode the image, or
+    recompressing would not make the upload smaller.
+    """
+    stats = {
+        "original_bytes": len(data),
+        "uploaded_bytes": len(data),
+        "bytes_saved": 0,
+        "preprocessed": False
+    }
+    if not IMAGE_PREPROCESS or IMAGE_FORMAT not in MIME_TYPES:
+        return data, mime_type, stats
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("Pillow is not installed; uploading images without preprocessing")
+        return data, mime_type, stats
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            original_size = image.size
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            if image.mode not in ("RGB", "L") and not (IMAGE_FORMAT == "WEBP" and image.mode == "RGBA"):
+                image = image.convert("RGB")
+
+            output = io.BytesIO()
+            image.save(output, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+            processed = output.getvalue()
+            size = image.size
+    except Exception as e:
+        logger.warning(f"Could not preprocess image, uploading original: {str(e)}")
+        return data, mime_type, stats
+
+    if len(processed) >= len(data):
+        return data, mime_type, stats
+
+    stats.update({
+        "uploaded_bytes": len(processed),
+        "bytes_saved": len(data) - len(processed),
+        "preprocessed": True,
+        "original_size": list(original_size),
+        "size": list(size)
+    })
+    return processed, MIME_TYPES[IMAGE_FORMAT], stats
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Memory tier size in entries (0 disables it), disk tier directory (empty disables it),
+# and how long results stay valid in either tier (seconds)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 512))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "result_cache"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 7 * 24 * 60 * 60))
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_DISK_MAX_ENTRIES", 20000))
+
+# Check the disk tier's size every this many writes
+PRUNE_INTERVAL = 100
+
+
+def make_key(content_hash, model, *prompts):
+    """
+    Build a cache key from the image content hash, the model name and a hash of every prompt
+    involved, so editing a prompt or switching models invalidates earlier results.
+    """
+    digest = hashlib.sha256()
+    digest.update(content_hash.encode())
+    digest.update(model.encode())
+    for prompt in prompts:
+        digest.update(hashlib.sha256(prompt.encode()).digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache for Predictor results: an in-memory LRU in front of a
+    directory of JSON files, one per key. Disk hits are promoted to memory.
+    """
+
+    def __init__(self, max_entries, directory, ttl, disk_max_entries):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.ttl = ttl
+        self.disk_max_entries = disk_max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Could not create result cache directory {self.directory}, caching in memory only: {str(e)}")
+                self.directory = ""
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    metrics.record_cache_lookup("result", True)
+                    return value
+                del self.memory[key]
+
+        value = self.read_disk(key, now)
+        with self.lock:
+            if value is None:
+                self.counters["misses"] += 1
+                metrics.record_cache_lookup("result", False)
+                return None
+            self.counters["disk_hits"] += 1
+            metrics.record_cache_lookup("result", True)
+            self.remember(key, value, now + self.ttl)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.remember(key, value, time.time() + self.ttl)
+        self.write_disk(key, value)
+
+    def remember(self, key, value, expires_at):
+        # Caller holds the lock
+        if self.max_entries <= 0:
+            return
+        self.memory[key] = (value, expires_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def read_disk(self, key, now):
+        if not self.directory:
+            return None
+        path = self.path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_disk(self, key, value):
+        if not self.directory:
+            return
+        # Write to a temporary name first so readers never see a partial file
+        path = self.path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write result cache entry {key}: {str(e)}")
+            return
+
+        with self.lock:
+            self.writes += 1
+            should_prune = self.writes % PRUNE_INTERVAL == 0
+        if should_prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        # Drop the least recently written files beyond the disk tier's size limit
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        except OSError:
+            return
+        excess = len(entries) - self.disk_max_entries
+        if excess <= 0:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            with self.lock:
+                self.counters["disk_evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+            lookups = hits + self.counters["misses"]
+            return {
+                **self.counters,
+                "memory_entries": len(self.memory),
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR, RESULT_CACHE_TTL, RESULT_CACHE_DISK_MAX_ENTRIES)
+
+
+def collect_result_cache_metrics():
+    stats = result_cache.stats()
+    return [
+        ("ecobite_cache_entries", "Entries held by each cache", "gauge", {"cache": "result"}, stats["memory_entries"]),
+        ("ecobite_result_cache_evictions_total", "Result cache evictions by tier", "counter", {"tier": "memory"}, stats["evictions"]),
+        ("ecobite_result_cache_evictions_total", "Result cache evictions by tier", "counter", {"tier": "disk"}, stats["disk_evictions"]),
+    ]
+
+
+metrics.register_collector(collect_result_cache_metrics)
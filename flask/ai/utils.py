@@ -1,34 +1,115 @@
-import requests
-import tempfile
+import io
+import hashlib
+import threading
+import time
 import os
+from collections import OrderedDict
 
-def get_file_extension(filename):
-    # Find the position of the last dot in the filename
-    last_dot_index = filename.rfind('.')
+from services import metrics, upstream
+from . import clients, preprocess
 
-    # If a dot is found and it's not the last character, return the extension
-    if last_dot_index != -1 and last_dot_index < len(filename) - 1:
-        return filename[last_dot_index + 1:]
-    else:
-        # If no valid extension is found, return an empty string or None
-        return
+# Gemini deletes uploaded files 48 hours after upload; expire our handles a bit earlier
+UPLOAD_TTL_SECONDS = int(os.getenv("GEMINI_FILE_TTL", 47 * 60 * 60))
+UPLOAD_CACHE_SIZE = int(os.getenv("GEMINI_UPLOAD_CACHE_SIZE", 1024))
+
+# Largest image we accept, and the total time allowed to download it (seconds)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 20 * 1024 * 1024))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 30))
+
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'mif1'}
+
+# Process-wide cache of uploaded Gemini files keyed by image content hash
+_upload_cache = OrderedDict()
+_upload_cache_lock = threading.Lock()
+
+def detect_mime_type(data):
+    """Detect an image's MIME type from its leading magic bytes."""
+    for magic, mime_type in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:8] == b'ftyp' and data[8:12] in HEIF_BRANDS:
+        return 'image/heic' if data[8:12] != b'mif1' else 'image/heif'
+    return None
 
 def download_file_from_url(url):
-    """Download a file from a URL and save it to a temporary file."""
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        # Create a temporary file
-        extension = get_file_extension(url)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix="."+extension)
-        with open(temp_file.name, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return temp_file.name
-    else:
-        raise Exception(f"Failed to download file from URL. Status code: {response.status_code}")
-
-def upload_file_to_gemini(url, client):
-    temp_file_path = download_file_from_url(url)
-    file = client.files.upload(file=temp_file_path)
-    os.remove(temp_file_path)
-    return file
\ No newline at end of file
+    """Download a file from a URL into memory, enforcing IMAGE_MAX_BYTES and IMAGE_DOWNLOAD_TIMEOUT."""
+    session = clients.get_http_session()
+    deadline = time.monotonic() + IMAGE_DOWNLOAD_TIMEOUT
+    with metrics.timed('download'), session.get(url, stream=True, timeout=clients.get_http_timeout()) as response:
+        if response.status_code != 200:
+            raise Exception(f"Failed to download file from URL. Status code: {response.status_code}")
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > IMAGE_MAX_BYTES:
+            raise ValueError(f"File at URL is {content_length} bytes, larger than the {IMAGE_MAX_BYTES} byte limit.")
+
+        buffer = bytearray()
+        for chunk in response.iter_content(chunk_size=65536):
+            buffer.extend(chunk)
+            if len(buffer) > IMAGE_MAX_BYTES:
+                raise ValueError(f"File at URL exceeds the {IMAGE_MAX_BYTES} byte limit.")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Downloading file from URL took longer than {IMAGE_DOWNLOAD_TIMEOUT} seconds.")
+        return bytes(buffer)
+
+def hash_bytes(data):
+    """Return the SHA-256 hex digest of some bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+def get_cached_upload(content_hash):
+    """Return a previously uploaded Gemini file and its preprocessing stats for this content hash, if it hasn't expired."""
+    with _upload_cache_lock:
+        entry = _upload_cache.get(content_hash)
+        if entry is None:
+            return None
+        file, stats, expires_at = entry
+        if expires_at <= time.time():
+            del _upload_cache[content_hash]
+            return None
+        _upload_cache.move_to_end(content_hash)
+        return file, stats
+
+def cache_upload(content_hash, file, stats):
+    with _upload_cache_lock:
+        _upload_cache[content_hash] = (file, stats, time.time() + UPLOAD_TTL_SECONDS)
+        _upload_cache.move_to_end(content_hash)
+        while len(_upload_cache) > UPLOAD_CACHE_SIZE:
+            _upload_cache.popitem(last=False)
+
+def upload_bytes_to_gemini(data, client, content_hash=None):
+    """
+    Preprocess image bytes and upload them to Gemini straight from memory, reusing an
+    earlier upload of the same content. Returns a tuple of (file, preprocessing stats).
+    """
+    content_hash = content_hash or hash_bytes(data)
+    cached = get_cached_upload(content_hash)
+    metrics.record_cache_lookup('gemini_upload', cached is not None)
+    if cached is not None:
+        return cached
+
+    mime_type = detect_mime_type(data)
+    if mime_type is None:
+        raise ValueError("Unsupported or unrecognized image format.")
+    with metrics.timed('preprocess'):
+        upload_data, mime_type, stats = preprocess.preprocess_image(data, mime_type)
+    with metrics.timed('upload'):
+        # Never hedged: a duplicate upload would only waste bandwidth and storage
+        file = upstream.gemini.call(
+            lambda: client.files.upload(file=io.BytesIO(upload_data), config={'mime_type': mime_type}),
+            hedge=False
+        )
+    cache_upload(content_hash, file, stats)
+    return file, stats
+
+def collect_upload_cache_metrics():
+    return [('ecobite_cache_entries', 'Entries held by each cache', 'gauge', {'cache': 'gemini_upload'}, len(_upload_cache))]
+
+metrics.register_collector(collect_upload_cache_metrics)
@@ -1,11 +1,26 @@
 # app.py
 
-from flask import Flask, jsonify, request
+from dotenv import load_dotenv
+
+# Load environment variables once at startup, before any module reads its configuration
+load_dotenv()
+
+from flask import Flask, Response, g, jsonify, request
 from datetime import datetime
-from services.density_service import density
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from services.density_service import density, get_densities
+from services.job_service import jobs
+from services import metrics
 import logging
+import queue
+import json
+import threading
+import contextvars
+import time
+import os
 
 from ai.predictor import Predictor
+from ai.result_cache import result_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -16,6 +31,30 @@ app = Flask(__name__)
 
 # Register the blueprint
 app.register_blueprint(density, url_prefix='/density')
+app.register_blueprint(jobs, url_prefix='/jobs')
+app.register_blueprint(metrics.metrics)
+
+# Worker pool for running independent prediction stages of one request concurrently
+analyze_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('ANALYZE_MAX_WORKERS', 8)),
+    thread_name_prefix='analyze'
+)
+
+# Worker pool for /predict/batch, shared by all batches, and the most images one batch may hold
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('BATCH_MAX_WORKERS', 8)),
+    thread_name_prefix='batch'
+)
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', 100))
+
+# Worker pool for /predict/stream, kept apart from analyze_executor so long-running streams
+# can't starve /analyze, the most streams that may be queued or running at once, and how
+# often an idle stream sends a keep-alive comment (seconds)
+STREAM_MAX_WORKERS = int(os.getenv('STREAM_MAX_WORKERS', 8))
+STREAM_MAX_PENDING = int(os.getenv('STREAM_MAX_PENDING', 2 * STREAM_MAX_WORKERS))
+STREAM_HEARTBEAT = float(os.getenv('STREAM_HEARTBEAT', 15))
+stream_executor = ThreadPoolExecutor(max_workers=STREAM_MAX_WORKERS, thread_name_prefix='stream')
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_PENDING)
 
 # Basic error handling
 class APIError(Exception):
@@ -31,6 +70,18 @@ def handle_api_error(error):
     response.status_code = error.status_code
     return response
 
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    # Clients can ask for a per-stage timing breakdown with ?timings=1
+    metrics.start_request_timings(request.args.get('timings', '').lower() in ('1', 'true', 'yes'))
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' in g:
+        metrics.request_seconds.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint or 'unknown')
+    return response
+
 # Routes
 @app.route('/')
 def home():
@@ -68,17 +119,154 @@ def predict():
     data = request.get_json()
     image = data['image']
 
-    predictor = Predictor(image)
+    predictor = Predictor(image, fused=data.get('fused'))
+
+    result = predictor.predict()
+    if metrics.request_timings() is not None:
+        result['timings'] = metrics.request_timings()
+    result['timestamp'] = datetime.now().isoformat()
+    return jsonify(result)
 
-    food_prediction = predictor.get_foods()
-    volume_prediction, map = predictor.get_volume(food_prediction)
-    weight_prediction, map = predictor.get_weight(map)
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    if not request.is_json:
+        raise APIError('Content-Type must be application/json')
+
+    data = request.get_json()
+    images = data.get('images')
+    if not isinstance(images, list) or not images:
+        raise APIError('Request must include a non-empty "images" list')
+    if len(images) > BATCH_MAX_IMAGES:
+        raise APIError(f'A batch may contain at most {BATCH_MAX_IMAGES} images')
+
+    fused = data.get('fused')
+
+    def predict_volumes(image):
+        predictor = Predictor(image, fused=fused)
+        return (predictor,) + predictor.predict_volumes()
+
+    def image_result(index, image, predictor, map, mode, densities):
+        sources, weights = predictor.get_weight(map, densities)
+        return {
+            'index': index,
+            'image': image,
+            'response': weights,
+            'sources': sources,
+            'mode': mode,
+            'cached': 'volumes' in predictor.cached,
+            'near_duplicate': predictor.near_duplicate
+        }
+
+    def image_error(index, image, error):
+        logger.error(f"Batch prediction failed for {image}: {str(error)}")
+        return {'index': index, 'image': image, 'error': str(error)}
+
+    futures = {batch_executor.submit(predict_volumes, image): (index, image) for index, image in enumerate(images)}
+
+    # Density lookups are shared across the whole batch
+    densities = {}
+
+    if data.get('stream'):
+        # Emit one JSON line per image as soon as it finishes
+        def generate():
+            for future in as_completed(futures):
+                index, image = futures[future]
+                try:
+                    predictor, food_prediction, map, mode = future.result()
+                    result = image_result(index, image, predictor, map, mode, densities)
+                except Exception as e:
+                    result = image_error(index, image, e)
+                yield json.dumps(result) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+
+    results = [None] * len(images)
+    predictions = []
+    for future in as_completed(futures):
+        index, image = futures[future]
+        try:
+            predictions.append((index, image) + future.result())
+        except Exception as e:
+            results[index] = image_error(index, image, e)
+
+    # Resolve every distinct food in the batch at once, then weigh each image
+    densities.update(get_densities([food for _, _, _, _, map, _ in predictions for food in map]))
+    for index, image, predictor, food_prediction, map, mode in predictions:
+        try:
+            results[index] = image_result(index, image, predictor, map, mode, densities)
+        except Exception as e:
+            results[index] = image_error(index, image, e)
 
     return jsonify({
-        'response': map,
+        'results': results,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/predict/stream', methods=['POST'])
+def predict_stream():
+    if not request.is_json:
+        raise APIError('Content-Type must be application/json')
+
+    data = request.get_json()
+    image = data['image']
+
+    predictor = Predictor(image, fused=data.get('fused'), stream=True)
+    events = queue.Queue()
+
+    # Run the pipeline beside the response, emitting a server-sent event as each stage completes
+    def run():
+        try:
+            food_prediction, map, mode = predictor.predict_volumes(
+                on_foods=lambda foods: events.put(('foods', {'foods': foods.split(', ')})))
+            events.put(('volumes', {'volumes': map, 'mode': mode}))
+            sources, map = predictor.get_weight(map)
+            events.put(('weights', {'response': map, 'sources': sources}))
+            events.put(('done', {
+                'image_stats': predictor.image_stats,
+                'cached': 'volumes' in predictor.cached,
+                'near_duplicate': predictor.near_duplicate,
+                'timestamp': datetime.now().isoformat()
+            }))
+        except Exception as e:
+            logger.error(f"Streaming prediction failed for {image}: {str(e)}")
+            events.put(('error', {'error': str(e)}))
+        finally:
+            stream_slots.release()
+            events.put(None)
+
+    if not stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open streams, retry later'})
+        response.status_code = 429
+        response.headers['Retry-After'] = '1'
+        return response
+    try:
+        stream_executor.submit(run)
+    except RuntimeError:
+        stream_slots.release()
+        raise
+
+    def generate():
+        while True:
+            try:
+                item = events.get(timeout=STREAM_HEARTBEAT)
+            except queue.Empty:
+                # Keep proxies from closing the connection while a stage is still running
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                return
+            event, payload = item
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/predict/cache-stats', methods=['GET'])
+def predict_cache_stats():
+    return jsonify(result_cache.stats())
+
 @app.route('/description', methods=['POST'])
 def fullness():
     if not request.is_json:
@@ -93,9 +281,58 @@ def fullness():
 
     return jsonify({
         'response': map,
+        'cached': 'description' in predictor.cached,
         'timestamp': datetime.now().isoformat()
     })
 
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    if not request.is_json:
+        raise APIError('Content-Type must be application/json')
+
+    data = request.get_json()
+    image = data['image']
+
+    # Both branches share the predictor, so the image is downloaded and uploaded once
+    predictor = Predictor(image, fused=data.get('fused'))
+
+    def predict_weights():
+        food_prediction, map, mode = predictor.predict_volumes()
+        sources, weights = predictor.get_weight(map)
+        return {'foods': food_prediction, 'volumes': map, 'response': weights, 'sources': sources, 'mode': mode}
+
+    # Each branch runs in a copy of this request's context so its timings are collected
+    description_future = analyze_executor.submit(contextvars.copy_context().run, predictor.get_description)
+    prediction_future = analyze_executor.submit(contextvars.copy_context().run, predict_weights)
+
+    result = {}
+    errors = {}
+    try:
+        result['description'] = description_future.result()
+    except Exception as e:
+        logger.error(f"Description failed for {image}: {str(e)}")
+        errors['description'] = str(e)
+    try:
+        result.update(prediction_future.result())
+    except Exception as e:
+        logger.error(f"Prediction failed for {image}: {str(e)}")
+        errors['prediction'] = str(e)
+
+    if len(errors) == 2:
+        raise APIError(f"Analysis failed: {errors['prediction']}", status_code=502)
+
+    result['image_stats'] = predictor.image_stats
+    result['cached'] = {
+        'description': 'description' in predictor.cached,
+        'prediction': 'volumes' in predictor.cached
+    }
+    result['near_duplicate'] = predictor.near_duplicate
+    result['errors'] = errors
+    if metrics.request_timings() is not None:
+        result['timings'] = metrics.request_timings()
+    result['timestamp'] = datetime.now().isoformat()
+    return jsonify(result)
+
 
 if __name__ == '__main__':
     # Enable hot reloading and run on localhost
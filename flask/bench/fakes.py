@@ -0,0 +1,353 @@
+"""
+Local stand-ins for the Gemini and Perplexity clients, plus a tiny image server.
+
+The fakes mimic just enough of google-genai and the OpenAI-compatible Perplexity
+client for Predictor and density_service to run unchanged. Latency, error rate
+and the canned <json> responses are configurable, and every call is counted so
+benchmarks can report upstream traffic.
+"""
+import http.server
+import json
+import math
+import random
+import socketserver
+import struct
+import threading
+import time
+import types
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+from ai.predictor import DESCRIPTION_PROMPT, FOODS_PROMPT, FUSED_PROMPT, VOLUME_PROMPT
+
+# Foods the fake Gemini picks from; mixes reference-table hits with names that need Perplexity
+DEFAULT_FOODS = (
+    'white rice', 'chicken nuggets', 'broccoli', 'mashed potatoes', 'apple juice',
+    'caesar salad', 'beef stew', 'garlic bread', 'tofu stir fry', 'mango lassi',
+    'french fries', 'pasta salad', 'black beans', 'fried plantains', 'miso soup',
+)
+
+_VOLUME_PROMPT_PREFIX, _VOLUME_PROMPT_SUFFIX = VOLUME_PROMPT.split('%s')
+
+
+class FakeUpstreamError(Exception):
+    """Raised by the fakes to simulate an upstream failure such as a 429 or 503."""
+
+    def __init__(self, status_code: int, message: str = 'simulated upstream error'):
+        super().__init__(f"{status_code} {message}")
+        # google-genai errors carry .code, OpenAI errors carry .status_code
+        self.status_code = status_code
+        self.code = status_code
+
+
+class Latency:
+    """
+    Latency distribution for a fake call, in seconds.
+
+    'fixed' always waits `median`; 'uniform' waits between `median * (1 - spread)`
+    and `median * (1 + spread)`; 'lognormal' has the given median and `spread`
+    as sigma, which gives the long tail real model APIs show.
+    """
+
+    def __init__(self, median: float = 0.0, distribution: str = 'lognormal', spread: float = 0.5,
+                 seed: Optional[int] = None):
+        if distribution not in ('fixed', 'uniform', 'lognormal'):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.median = median
+        self.distribution = distribution
+        self.spread = spread
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self.lock:
+            if self.distribution == 'uniform':
+                return self.random.uniform(self.median * (1 - self.spread), self.median * (1 + self.spread))
+            if self.distribution == 'lognormal':
+                return self.random.lognormvariate(math.log(self.median), self.spread)
+        return self.median
+
+    def wait(self) -> None:
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FaultInjector:
+    """Fails a share of calls with one of the given status codes."""
+
+    def __init__(self, error_rate: float = 0.0, status_codes: Sequence[int] = (429, 503), seed: Optional[int] = None):
+        self.error_rate = error_rate
+        self.status_codes = tuple(status_codes)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def maybe_fail(self) -> None:
+        if self.error_rate <= 0:
+            return
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            status_code = self.random.choice(self.status_codes)
+        if failed:
+            raise FakeUpstreamError(status_code)
+
+
+class CallLog:
+    """Thread-safe counts of calls and failures by name."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, name: str, failed: bool = False) -> None:
+        with self.lock:
+            self.calls[name] += 1
+            if failed:
+                self.errors[name] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> types.SimpleNamespace:
+    return types.SimpleNamespace(
+        prompt_token_count=prompt_tokens,
+        candidates_token_count=completion_tokens,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    )
+
+
+class _FakeModels:
+    def __init__(self, owner: 'FakeGeminiClient'):
+        self.owner = owner
+
+    def generate_content(self, model: str, contents: list, **kwargs) -> types.SimpleNamespace:
+        text = self.owner.respond(contents)
+        return types.SimpleNamespace(text=text, usage_metadata=_usage(self.owner.prompt_tokens, len(text) // 4))
+
+    def generate_content_stream(self, model: str, contents: list, **kwargs):
+        text = self.owner.respond(contents)
+        chunk_size = self.owner.stream_chunk_size
+        for start in range(0, len(text), chunk_size):
+            last = start + chunk_size >= len(text)
+            yield types.SimpleNamespace(
+                text=text[start:start + chunk_size],
+                usage_metadata=_usage(self.owner.prompt_tokens, len(text) // 4) if last else None
+            )
+
+
+class _FakeFiles:
+    def __init__(self, owner: 'FakeGeminiClient'):
+        self.owner = owner
+
+    def upload(self, file, config=None) -> types.SimpleNamespace:
+        data = file.read() if hasattr(file, 'read') else open(file, 'rb').read()
+        self.owner.call('upload')
+        mime_type = (config or {}).get('mime_type') if isinstance(config, dict) else None
+        return types.SimpleNamespace(
+            name=f"files/fake-{self.owner.next_id()}",
+            uri='https://generativelanguage.invalid/files/fake',
+            mime_type=mime_type,
+            size_bytes=len(data)
+        )
+
+
+class FakeGeminiClient:
+    """
+    Stand-in for genai.Client. Recognises the Predictor prompts and answers each
+    with a canned <json> block after waiting for the configured latency.
+    Responses can be overridden per prompt name ('foods', 'volumes', 'fused', 'description').
+    """
+
+    def __init__(self, latency: Optional[Latency] = None, upload_latency: Optional[Latency] = None,
+                 faults: Optional[FaultInjector] = None, foods: Sequence[str] = DEFAULT_FOODS,
+                 foods_per_image: int = 3, responses: Optional[Dict[str, str]] = None,
+                 prompt_tokens: int = 1300, stream_chunk_size: int = 16, seed: Optional[int] = None):
+        self.latency = latency or Latency()
+        self.upload_latency = upload_latency or Latency()
+        self.faults = faults or FaultInjector()
+        self.foods = list(foods)
+        self.foods_per_image = foods_per_image
+        self.responses = responses or {}
+        self.prompt_tokens = prompt_tokens
+        self.stream_chunk_size = stream_chunk_size
+        self.random = random.Random(seed)
+        self.log = CallLog()
+        self.lock = threading.Lock()
+        self.ids = 0
+        self.models = _FakeModels(self)
+        self.files = _FakeFiles(self)
+
+    def next_id(self) -> int:
+        with self.lock:
+            self.ids += 1
+            return self.ids
+
+    def call(self, name: str) -> None:
+        (self.upload_latency if name == 'upload' else self.latency).wait()
+        try:
+            self.faults.maybe_fail()
+        except FakeUpstreamError:
+            self.log.record(name, failed=True)
+            raise
+        self.log.record(name)
+
+    def pick_foods(self) -> List[str]:
+        with self.lock:
+            return self.random.sample(self.foods, min(self.foods_per_image, len(self.foods)))
+
+    def volumes(self, foods: Sequence[str]) -> Dict[str, float]:
+        with self.lock:
+            return {food: round(self.random.uniform(0.05, 0.4), 3) for food in foods}
+
+    def respond(self, contents: list) -> str:
+        prompt = contents[0] if contents and isinstance(contents[0], str) else ''
+        if prompt == FOODS_PROMPT:
+            name = 'foods'
+        elif prompt == FUSED_PROMPT:
+            name = 'fused'
+        elif prompt == DESCRIPTION_PROMPT:
+            name = 'description'
+        elif prompt.startswith(_VOLUME_PROMPT_PREFIX):
+            name = 'volumes'
+        else:
+            name = 'other'
+        self.call(name)
+
+        if name in self.responses:
+            return self.responses[name]
+        if name == 'foods':
+            payload = {'foods': self.pick_foods()}
+        elif name == 'fused':
+            payload = self.volumes(self.pick_foods())
+        elif name == 'volumes':
+            listed = prompt[len(_VOLUME_PROMPT_PREFIX):].split('\n')[0]
+            payload = self.volumes([food.strip() for food in listed.split(',') if food.strip()])
+        elif name == 'description':
+            payload = {'name': 'Mixed plate', 'description': 'About 60% of the plate has been eaten.'}
+        else:
+            payload = {}
+        return f"Looking at the image.\n<json>{json.dumps(payload)}</json>"
+
+
+class _FakeCompletions:
+    def __init__(self, owner: 'FakePerplexityClient'):
+        self.owner = owner
+
+    def create(self, model: str, messages: list, **kwargs) -> types.SimpleNamespace:
+        return self.owner.create(messages)
+
+
+class FakePerplexityClient:
+    """
+    Stand-in for the OpenAI-compatible Perplexity client. Answers density
+    questions with a stable pseudo-random value per food name, or a fixed
+    `answer` if one is given.
+    """
+
+    def __init__(self, latency: Optional[Latency] = None, faults: Optional[FaultInjector] = None,
+                 answer: Optional[str] = None):
+        self.latency = latency or Latency()
+        self.faults = faults or FaultInjector()
+        self.answer = answer
+        self.log = CallLog()
+        self.chat = types.SimpleNamespace(completions=_FakeCompletions(self))
+
+    def create(self, messages: list) -> types.SimpleNamespace:
+        self.latency.wait()
+        try:
+            self.faults.maybe_fail()
+        except FakeUpstreamError:
+            self.log.record('density', failed=True)
+            raise
+        self.log.record('density')
+
+        question = messages[-1]['content'] if messages else ''
+        answer = self.answer
+        if answer is None:
+            answer = f"{0.5 + (zlib.crc32(question.encode()) % 700) / 1000:.3f}"
+        prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=answer))],
+            usage=_usage(prompt_tokens, 3)
+        )
+
+
+def make_png(seed: int, size: int = 128) -> bytes:
+    """Build an RGB PNG whose pattern depends on seed, so every seed hashes (and dhashes) differently."""
+    rng = random.Random(seed)
+    fx, fy, phase = rng.uniform(0.02, 0.2), rng.uniform(0.02, 0.2), rng.uniform(0, 2 * math.pi)
+    base = [rng.randrange(256) for _ in range(3)]
+    rows = bytearray()
+    for y in range(size):
+        rows.append(0)
+        for x in range(size):
+            wave = int(127 * math.sin(fx * x + fy * y + phase))
+            rows.extend((channel + wave * (i + 1)) % 256 for i, channel in enumerate(base))
+
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(bytes(rows))) + chunk(b'IEND', b'')
+
+
+class ImageServer:
+    """
+    Serves generated PNGs over HTTP on localhost: GET /<n>.png returns image n.
+    Images are generated once and kept, so repeated URLs return identical bytes.
+    """
+
+    def __init__(self, latency: Optional[Latency] = None, size: int = 128):
+        self.latency = latency or Latency()
+        self.size = size
+        self.images: Dict[int, bytes] = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def image(self, seed: int) -> bytes:
+        with self.lock:
+            if seed not in self.images:
+                self.images[seed] = make_png(seed, self.size)
+            return self.images[seed]
+
+    def start(self) -> str:
+        owner = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    seed = int(self.path.strip('/').rsplit('.', 1)[0])
+                except ValueError:
+                    self.send_error(404)
+                    return
+                owner.latency.wait()
+                body = owner.image(seed)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def url(self, base: str, seed: int) -> str:
+        return f"{base}/{seed}.png"
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
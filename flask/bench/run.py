@@ -0,0 +1,212 @@
+"""
+Offline load benchmark for the Flask app.
+
+Drives /predict, /description and /density/process-foods in-process at fixed
+concurrency levels, with the Gemini and Perplexity clients replaced by the local
+fakes in bench.fakes, and reports throughput, p50/p95/p99 latency and upstream
+call counts for each run. No API keys are needed and nothing is billed.
+
+Run from the flask directory:
+
+    python -m bench.run --concurrency 1,4,16 --requests 100
+    python -m bench.run --endpoints predict --gemini-latency 1.5 --error-rate 0.05 --json
+
+Caches are written to a temporary directory, so every invocation starts cold.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+ENDPOINTS = ('predict', 'description', 'process-foods')
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                        help='comma-separated endpoints to drive (default: %(default)s)')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma-separated concurrency levels (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint and level (default: %(default)s)')
+    parser.add_argument('--images', type=int, default=0,
+                        help='distinct images to cycle through; 0 gives every request a new image (default: %(default)s)')
+    parser.add_argument('--fused', action='store_true', help='use the fused single-call prediction mode')
+    parser.add_argument('--gemini-latency', type=float, default=0.8, help='median Gemini generate latency in seconds')
+    parser.add_argument('--upload-latency', type=float, default=0.2, help='median Gemini upload latency in seconds')
+    parser.add_argument('--perplexity-latency', type=float, default=0.6, help='median Perplexity latency in seconds')
+    parser.add_argument('--image-latency', type=float, default=0.02, help='median image download latency in seconds')
+    parser.add_argument('--distribution', default='lognormal', choices=('fixed', 'uniform', 'lognormal'),
+                        help='latency distribution for every fake (default: %(default)s)')
+    parser.add_argument('--spread', type=float, default=0.5,
+                        help='lognormal sigma, or relative half-width for uniform (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream calls that fail')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for latencies, errors and foods')
+    parser.add_argument('--json', action='store_true', help='print results as JSON instead of a table')
+    parser.add_argument('--verbose', action='store_true', help='keep the app\'s log output')
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def diff_calls(before: Dict[str, Dict[str, int]], after: Dict[str, Dict[str, int]], kind: str) -> Dict[str, int]:
+    return {
+        name: count - before[kind].get(name, 0)
+        for name, count in sorted(after[kind].items())
+        if count - before[kind].get(name, 0)
+    }
+
+
+def run_level(app, make_request: Callable[[int], Tuple[str, dict]], concurrency: int, total: int) -> Dict:
+    """Send `total` requests with `concurrency` workers and return latency statistics."""
+    local = threading.local()
+
+    def send(i: int) -> Tuple[float, int]:
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        path, body = make_request(i)
+        start = time.perf_counter()
+        response = local.client.post(path, json=body)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status >= 400)
+    return {
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(total / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def print_table(rows: List[Dict]) -> None:
+    header = f"{'endpoint':<14} {'conc':>4} {'reqs':>5} {'errs':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  upstream calls"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        calls = ', '.join(f"{name}={count}" for name, count in row['upstream'].items()) or '-'
+        print(
+            f"{row['endpoint']:<14} {row['concurrency']:>4} {row['requests']:>5} {row['errors']:>5} "
+            f"{row['throughput']:>8.2f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f}  {calls}"
+        )
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        print(f"Unknown endpoints: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+
+    # Caches and clients are configured at import time, so point them at a scratch
+    # directory before the app is imported
+    scratch = tempfile.mkdtemp(prefix='ecobite-bench-')
+    os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(scratch, 'result_cache'))
+    os.environ.setdefault('DENSITY_CACHE_PATH', os.path.join(scratch, 'density_cache.sqlite3'))
+    os.environ.setdefault('PERPLEXITY_API_KEY', 'bench')
+
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    from ai import clients
+    from services import density_service
+    from bench.fakes import (DEFAULT_FOODS, FakeGeminiClient, FakePerplexityClient, FaultInjector,
+                             ImageServer, Latency)
+    from app import app
+
+    def latency(median: float, offset: int) -> Latency:
+        return Latency(median, args.distribution, args.spread, seed=args.seed + offset)
+
+    gemini = FakeGeminiClient(
+        latency=latency(args.gemini_latency, 1),
+        upload_latency=latency(args.upload_latency, 2),
+        faults=FaultInjector(args.error_rate, seed=args.seed + 3),
+        seed=args.seed
+    )
+    perplexity = FakePerplexityClient(
+        latency=latency(args.perplexity_latency, 4),
+        faults=FaultInjector(args.error_rate, seed=args.seed + 5)
+    )
+    clients.set_gemini_client(gemini)
+    density_service.set_client(perplexity)
+
+    images = ImageServer(latency=latency(args.image_latency, 6))
+    base_url = images.start()
+    foods_random = random.Random(args.seed)
+    foods_lock = threading.Lock()
+    next_image = [0]
+
+    def image_request(path: str, offset: int) -> Callable[[int], Tuple[str, dict]]:
+        def make(i: int) -> Tuple[str, dict]:
+            seed = i % args.images if args.images else offset + i
+            body = {'image': images.url(base_url, seed)}
+            if path == '/predict' and args.fused:
+                body['fused'] = True
+            return path, body
+        return make
+
+    def foods_request(i: int) -> Tuple[str, dict]:
+        with foods_lock:
+            foods = foods_random.sample(DEFAULT_FOODS, 3)
+        return '/density/process-foods', {'foods': [{'name': food} for food in foods]}
+
+    rows = []
+    try:
+        for endpoint in endpoints:
+            for concurrency in levels:
+                if endpoint == 'process-foods':
+                    make_request = foods_request
+                else:
+                    # Fresh images per run unless --images is set, so result caches stay cold
+                    make_request = image_request('/' + endpoint, next_image[0])
+                    next_image[0] += args.requests
+                before = {'gemini': gemini.log.snapshot(), 'perplexity': perplexity.log.snapshot()}
+                stats = run_level(app, make_request, concurrency, args.requests)
+                upstream, upstream_errors = {}, {}
+                for provider, log in (('gemini', gemini.log), ('perplexity', perplexity.log)):
+                    after = log.snapshot()
+                    for name, count in diff_calls(before[provider], after, 'calls').items():
+                        upstream[f"{provider}.{name}"] = count
+                    for name, count in diff_calls(before[provider], after, 'errors').items():
+                        upstream_errors[f"{provider}.{name}"] = count
+                rows.append({
+                    'endpoint': endpoint, 'concurrency': concurrency, **stats,
+                    'upstream': upstream, 'upstream_errors': upstream_errors
+                })
+                print(f"{endpoint} x{concurrency}: {stats['throughput']} req/s", file=sys.stderr)
+    finally:
+        images.stop()
+
+    if args.json:
+        print(json.dumps({'config': vars(args), 'results': rows}, indent=2))
+    else:
+        print_table(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, Dict, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+class DensityCache:
+    """
+    Durable cache for densities resolved through the Perplexity API.
+    Entries live in a SQLite file and are mirrored in memory on startup.
+    Negative answers (None or 0.000) are kept too, with their own TTL.
+    If the SQLite file cannot be opened, the cache runs in memory only.
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[Optional[float], float]] = {}
+
+        self._conn: Optional[sqlite3.Connection] = None
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS densities ("
+                "food_name TEXT PRIMARY KEY, density REAL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._load()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open density cache {path}, caching in memory only: {str(e)}")
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._entries.clear()
+
+    @staticmethod
+    def _key(food_name: str) -> str:
+        return food_name.strip().lower()
+
+    def _expires_at(self, density: Optional[float], created_at: float) -> float:
+        ttl = self.ttl if density else self.negative_ttl
+        return created_at + ttl
+
+    def _load(self) -> None:
+        now = time.time()
+        rows = self._conn.execute("SELECT food_name, density, created_at FROM densities").fetchall()
+        expired = []
+        for food_name, density, created_at in rows:
+            expires_at = self._expires_at(density, created_at)
+            if expires_at <= now:
+                expired.append((food_name,))
+                continue
+            self._entries[food_name] = (density, expires_at)
+        if expired:
+            self._conn.executemany("DELETE FROM densities WHERE food_name = ?", expired)
+            self._conn.commit()
+        logger.info(f"Loaded {len(self._entries)} cached densities from {self.path} ({len(expired)} expired)")
+
+    def get(self, food_name: str) -> Tuple[bool, Optional[float]]:
+        """
+        Look up a food in the cache.
+        Returns a tuple of (found, density_value); density_value may be None for a negative entry.
+        """
+        key = self._key(food_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry[0]
+
+    def set(self, food_name: str, density: Optional[float]) -> None:
+        """Store an API-resolved density, or a negative entry when density is None or 0."""
+        key = self._key(food_name)
+        created_at = time.time()
+        with self._lock:
+            self._entries[key] = (density, self._expires_at(density, created_at))
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO densities (food_name, density, created_at) VALUES (?, ?, ?)",
+                (key, density, created_at)
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
@@ -1,121 +1,147 @@
 from flask import Blueprint, jsonify, request
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
 import logging
-from typing import Optional, Dict, List, Union, Tuple
+import threading
+import contextvars
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Dict, List, Union, Tuple
 from functools import lru_cache
-import pandas as pd
+
+from . import metrics, upstream
+from .density_cache import DensityCache
+from .reference_index import ReferenceIndex
+from .reference_table import DATA_DIR, load_reference_table
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
 # Create blueprint for density service
 density = Blueprint('density', __name__)
 
-# Initialize Perplexity client
-client = OpenAI(
-    api_key=os.getenv('PERPLEXITY_API_KEY'),
-    base_url="https://api.perplexity.ai"
+# Per-attempt timeout for Perplexity calls (seconds)
+PERPLEXITY_TIMEOUT = float(os.getenv('PERPLEXITY_TIMEOUT', 30))
+
+# Perplexity client, created on first use and shared by the process; it pools its own HTTP connections
+client: Optional['OpenAI'] = None
+_client_lock = threading.Lock()
+
+def get_client() -> 'OpenAI':
+    """
+    Return the Perplexity client. The SDK is imported here rather than at module
+    import so workers that never miss the reference table don't pay for it.
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import OpenAI
+                # Retries are handled by services.upstream, so the SDK's own are turned off
+                client = OpenAI(
+                    api_key=os.getenv('PERPLEXITY_API_KEY'),
+                    base_url="https://api.perplexity.ai",
+                    timeout=PERPLEXITY_TIMEOUT,
+                    max_retries=0
+                )
+    return client
+
+def set_client(new_client: 'OpenAI') -> None:
+    """
+    Replace the Perplexity client, e.g. with a local stand-in for benchmarks.
+    """
+    global client
+    with _client_lock:
+        client = new_client
+
+# Minimum score for a fuzzy reference match to be used instead of the API
+DENSITY_MATCH_THRESHOLD = float(os.getenv('DENSITY_MATCH_THRESHOLD', 0.85))
+
+# Number of reference rows sent with each Perplexity prompt (0 sends the whole table)
+DENSITY_PROMPT_TOP_K = int(os.getenv('DENSITY_PROMPT_TOP_K', 15))
+
+# Log how many prompt tokens the trimmed reference saves compared to the whole table
+DENSITY_PROMPT_REPORT_SAVINGS = os.getenv('DENSITY_PROMPT_REPORT_SAVINGS', '').lower() in ('1', 'true', 'yes')
+
+# Durable cache of API-resolved densities, loaded at startup
+density_cache = DensityCache(
+    path=os.getenv('DENSITY_CACHE_PATH', os.path.join(DATA_DIR, 'density_cache.sqlite3')),
+    ttl=float(os.getenv('DENSITY_CACHE_TTL', 30 * 24 * 60 * 60)),
+    negative_ttl=float(os.getenv('DENSITY_CACHE_NEGATIVE_TTL', 24 * 60 * 60))
 )
 
+# Bounded worker pool for density lookups; misses block on the Perplexity API
+DENSITY_MAX_WORKERS = int(os.getenv('DENSITY_MAX_WORKERS', 8))
+executor = ThreadPoolExecutor(max_workers=DENSITY_MAX_WORKERS, thread_name_prefix='density')
+
+# Lookups currently running, keyed by normalized food name, shared across requests
+_in_flight: Dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
 @lru_cache(maxsize=1)
 def load_reference_file() -> Tuple[Optional[Dict[str, float]], Optional[str]]:
     """
-    Load the reference CSV file containing food density values.
+    Load the reference food density values from the compiled reference table,
+    rebuilding it from the CSV if it is missing or stale.
     Returns a tuple of (density_dict, reference_text).
     density_dict maps food names to their density values.
     reference_text is the formatted text to be used in the API prompt.
     """
     try:
-        # Use relative path from the Flask app root
-        csv_path = 'data/food_density_reference.csv'
-        logger.info(f"Attempting to load CSV from relative path: {csv_path}")
-        
-        df = pd.read_csv(csv_path)
-        logger.info(f"Successfully loaded CSV with {len(df)} rows")
-        logger.info(f"CSV columns: {df.columns.tolist()}")
-        logger.info("First few rows of DataFrame:")
-        logger.info(df.head())
-        
-        # Process the CSV data to create a dictionary and reference text
-        density_dict = {}
-        reference_lines = []
-        
-        for _, row in df.iterrows():
-            # Skip empty rows or headers
-            if pd.isna(row['Food name']) or pd.isna(row['Density']):
-                continue
-                
-            # Get the food name and clean it
-            food_name = str(row['Food name']).strip().strip('"').lower()
-            density_str = str(row['Density']).strip()
-            
-            # Skip category headers and empty food names
-            if not food_name or food_name.endswith(',') or pd.isna(density_str):
-                continue
-                
-            try:
-                # Handle range values (e.g., "0.56-0.72")
-                if '-' in density_str:
-                    low, high = map(float, density_str.split('-'))
-                    density_value = (low + high) / 2
-                else:
-                    density_value = float(density_str)
-                
-                density_dict[food_name] = density_value
-                reference_lines.append(f"{food_name}: {density_value} g/ml")
-                logger.debug(f"Added density for {food_name}: {density_value}")
-            except (ValueError, TypeError) as e:
-                logger.debug(f"Failed to parse density for {food_name}: {str(e)}")
-                continue
-                
-        logger.info(f"Successfully loaded {len(density_dict)} reference density values")
-        if density_dict:
-            # Log some sample entries
-            sample_entries = list(density_dict.items())[:5]
-            logger.info("Sample entries from parsed data:")
-            for food, density in sample_entries:
-                logger.info(f"  {food}: {density} g/ml")
-                
-        reference_text = "\n".join(reference_lines)
-        return density_dict, reference_text
-        
+        table = load_reference_table()
+        return table.as_dict(), table.reference_text()
     except Exception as e:
         logger.error(f"Failed to load reference file: {str(e)}")
         return None, None
     
-def get_density(food_name: str) -> Tuple[Optional[float], str]:
+@lru_cache(maxsize=1)
+def load_reference_index() -> Optional[ReferenceIndex]:
     """
-    Get food density by first checking the reference CSV, then falling back to Perplexity API.
-    Returns a tuple of (density_value, source) where source is either "reference" or "api"
+    Build the fuzzy match index over the reference densities once per process.
     """
-    # Load reference data
-    density_dict, reference_text = load_reference_file()
-    
-    # Check for exact match in reference data
-    if density_dict and food_name.lower() in density_dict:
-        density = density_dict[food_name.lower()]
-        logger.info(f"Found exact match in reference data for {food_name}: {density}")
-        return round(density, 3), "reference"
-    
-    # # Check for contains match in reference data
-    # if density_dict:
-    #     # Get all matching foods that contain the search term
-    #     matches = [(name, value) for name, value in density_dict.items() 
-    #               if food_name.lower() in name]
-        
-    #     # If we found matches, use the first one
-    #     if matches:
-    #         food_name, density = matches[0]
-    #         logger.info(f"Found contains match in reference data for {food_name}: {density}")
-    #         return round(density, 3)
+    density_dict, _ = load_reference_file()
+    if not density_dict:
+        return None
+    index = ReferenceIndex(density_dict)
+    logger.info(f"Built reference match index over {len(index)} foods with {len(index.token_index)} tokens")
+    return index
+
+def estimate_tokens(text: str) -> int:
+    # Rough token count for English prompts (~4 characters per token)
+    return len(text) // 4
+
+def build_reference_prompt(food_name: str, reference_text: Optional[str]) -> Optional[str]:
+    """
+    Select the reference densities to include in the Perplexity prompt.
+    Only the DENSITY_PROMPT_TOP_K rows most relevant to the food are sent, so the
+    prompt size stays constant as the reference table grows.
+    """
+    reference_index = load_reference_index()
+    if DENSITY_PROMPT_TOP_K <= 0 or not reference_index:
+        return reference_text
+
+    rows = reference_index.search(food_name, DENSITY_PROMPT_TOP_K)
+    trimmed_text = "\n".join(f"{name}: {density} g/ml" for name, density, _ in rows)
+
+    if DENSITY_PROMPT_REPORT_SAVINGS and reference_text:
+        full_tokens = estimate_tokens(reference_text)
+        trimmed_tokens = estimate_tokens(trimmed_text)
+        logger.info(
+            f"Reference prompt for {food_name}: {len(rows)} rows, ~{trimmed_tokens} tokens "
+            f"instead of ~{full_tokens} (saved ~{full_tokens - trimmed_tokens})"
+        )
+    return trimmed_text
+
+def query_density_api(food_name: str, reference_text: Optional[str]) -> Optional[float]:
+    """
+    Ask Perplexity for a food's density, using the most relevant reference rows as guidance.
+    Answers (including invalid ones) are stored in the persistent density cache.
+    """
+    reference_text = build_reference_prompt(food_name, reference_text)
 
-    # If no exact match, query Perplexity API with reference data
     system_content = (
         "You are a precise scientific assistant specializing in food science and density measurements. "
         "Your responses must follow these rules:\n"
@@ -142,29 +168,147 @@ def get_density(food_name: str) -> Tuple[Optional[float], str]:
     ]
 
     try:
-        response = client.chat.completions.create(
-            model="sonar-pro",
-            messages=messages,
+        with metrics.timed('perplexity'):
+            response = upstream.perplexity.call(lambda: get_client().chat.completions.create(
+                model="sonar-pro",
+                messages=messages,
+            ))
+        usage = getattr(response, 'usage', None)
+        metrics.record_tokens(
+            'perplexity', 'density',
+            getattr(usage, 'prompt_tokens', None),
+            getattr(usage, 'completion_tokens', None)
         )
         
         density_str = response.choices[0].message.content.strip()
-        try:
-            density = round(float(density_str), 3)
-            logger.info(f"Successfully got density from API for {food_name}: {density}")
-            return density, "api"
-        except ValueError:
-            logger.error(f"Invalid density value '{density_str}' for {food_name}")
-            return None, "api"
-            
     except Exception as e:
         logger.error(f"Perplexity API error for {food_name}: {str(e)}")
-        return None, "api"
+        return None
+
+    try:
+        density = round(float(density_str), 3)
+    except ValueError:
+        logger.error(f"Invalid density value '{density_str}' for {food_name}")
+        remember_density(food_name, None)
+        return None
+
+    logger.info(f"Successfully got density from API for {food_name}: {density}")
+    remember_density(food_name, density)
+    return density
+
+def remember_density(food_name: str, density: Optional[float]) -> None:
+    """
+    Store an API answer in the density cache. A failed write (e.g. a locked database
+    shared by several workers) is logged, and the answer is still used.
+    """
+    try:
+        density_cache.set(food_name, density)
+    except Exception as e:
+        logger.warning(f"Could not cache density for {food_name}: {str(e)}")
+
+def resolve_density(food_name: str) -> Dict[str, Union[str, float, None]]:
+    """
+    Get food density by first checking the reference CSV (exact, then fuzzy match), then the
+    persistent cache of earlier API answers, then falling back to Perplexity API.
+    Returns a dict with the density, its source ("reference" or "api"), and for reference
+    hits the matched reference name and match score.
+    """
+    start = time.perf_counter()
+    result = _resolve_density(food_name)
+    metrics.observe_stage('density_lookup', time.perf_counter() - start, source=result['source'])
+    return result
+
+def _resolve_density(food_name: str) -> Dict[str, Union[str, float, None]]:
+    # Load reference data
+    density_dict, reference_text = load_reference_file()
+    
+    # Check for exact match in reference data
+    if density_dict and food_name.lower() in density_dict:
+        density = density_dict[food_name.lower()]
+        logger.info(f"Found exact match in reference data for {food_name}: {density}")
+        return {
+            "density": round(density, 3),
+            "source": "reference",
+            "reference_name": food_name.lower(),
+            "match_score": 1.0
+        }
+    
+    # Check for a close match on normalized tokens and trigrams
+    reference_index = load_reference_index()
+    if reference_index:
+        match = reference_index.match(food_name, DENSITY_MATCH_THRESHOLD)
+        if match:
+            reference_name, density, score = match
+            logger.info(f"Found fuzzy match in reference data for {food_name}: {reference_name} ({score}): {density}")
+            return {
+                "density": round(density, 3),
+                "source": "reference",
+                "reference_name": reference_name,
+                "match_score": score
+            }
+
+    # Check densities previously resolved by the API, including negative answers
+    found, density = density_cache.get(food_name)
+    metrics.record_cache_lookup('density', found)
+    if not found:
+        # If no reference match, query Perplexity API with reference data
+        density = query_density_api(food_name, reference_text)
+    else:
+        logger.info(f"Found cached API density for {food_name}: {density}")
+
+    return {
+        "density": density,
+        "source": "api",
+        "reference_name": None,
+        "match_score": None
+    }
+
+def get_density(food_name: str) -> Tuple[Optional[float], str]:
+    """
+    Get food density, see resolve_density.
+    Returns a tuple of (density_value, source) where source is either "reference" or "api"
+    """
+    result = resolve_density(food_name)
+    return result["density"], result["source"]
+
+def _release_in_flight(key: str, future: Future) -> None:
+    with _in_flight_lock:
+        if _in_flight.get(key) is future:
+            del _in_flight[key]
+
+def submit_density(food_name: str) -> Future:
+    """
+    Schedule resolve_density on the worker pool.
+    Concurrent lookups of the same food (case-insensitive) share a single future.
+    """
+    key = food_name.strip().lower()
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            logger.debug(f"Joining in-flight density lookup for {food_name}")
+            return future
+        # Run in a copy of the caller's context so its per-request timings include the lookup
+        future = executor.submit(contextvars.copy_context().run, resolve_density, food_name)
+        _in_flight[key] = future
+    future.add_done_callback(lambda done: _release_in_flight(key, done))
+    return future
+
+def get_densities(food_names: List[str]) -> Dict[str, Dict[str, Union[str, float, None]]]:
+    """
+    Batched form of resolve_density. Distinct foods are resolved concurrently on the worker pool.
+    Returns a dict mapping each distinct food name to its resolve_density result.
+    """
+    futures = {}
+    for food_name in food_names:
+        if food_name not in futures:
+            futures[food_name] = submit_density(food_name)
+    return {food_name: future.result() for food_name, future in futures.items()}
 
 @density.route('/process-foods', methods=['POST'])
 def process_foods() -> tuple[Dict[str, Union[str, List[Dict[str, Union[str, float]]]]], int]:
     """
     Process a list of foods to get their densities.
-    First checks reference CSV for exact matches, then falls back to Perplexity API.
+    First checks reference CSV for exact and fuzzy matches, then falls back to Perplexity API.
     
     Expected request format:
     {
@@ -205,20 +349,39 @@ def process_foods() -> tuple[Dict[str, Union[str, List[Dict[str, Union[str, floa
             'foods': []
         }), 400
         
-    processed_foods = []
+    valid_foods = []
     for food in foods:
         if not isinstance(food, dict) or 'name' not in food:
             logger.warning(f"Skipping invalid food item: {food}")
             continue
-            
-        density_value, source = get_density(food['name'])
+        valid_foods.append(food)
+
+    densities = get_densities([food['name'] for food in valid_foods])
+
+    processed_foods = []
+    for food in valid_foods:
+        result = densities[food['name']]
         
         processed_foods.append({
             "food_name": food['name'],
-            "density": density_value if density_value is not None else 0.000,
-            "source": source
+            "density": result["density"] if result["density"] is not None else 0.000,
+            "source": result["source"],
+            "reference_name": result["reference_name"],
+            "match_score": result["match_score"]
         })
     
     return jsonify({
         'foods': processed_foods
-    }), 200
\ No newline at end of file
+    }), 200
+
+@density.route('/cache-stats', methods=['GET'])
+def cache_stats() -> tuple[Dict[str, Union[int, float]], int]:
+    """
+    Report hit/miss counters for the persistent density cache.
+    """
+    return jsonify(density_cache.stats()), 200
+
+def collect_density_cache_metrics() -> List[Tuple[str, str, str, Dict[str, str], float]]:
+    return [('ecobite_cache_entries', 'Entries held by each cache', 'gauge', {'cache': 'density'}, density_cache.stats()['entries'])]
+
+metrics.register_collector(collect_density_cache_metrics)
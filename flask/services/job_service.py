@@ -0,0 +1,160 @@
+from flask import Blueprint, jsonify, request, url_for
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Union
+
+from ai.predictor import Predictor
+from .job_store import JobStore
+from .reference_table import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Create blueprint for asynchronous prediction jobs
+jobs = Blueprint('jobs', __name__)
+
+# Workers running jobs, the most jobs that may be queued or running at once,
+# how long finished jobs are kept (seconds), and the longest allowed long-poll (seconds)
+JOB_MAX_WORKERS = int(os.getenv('JOB_MAX_WORKERS', 4))
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 64))
+JOB_TTL = float(os.getenv('JOB_TTL', 15 * 60))
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', 30))
+
+# Job state shared by every worker process, and how often a long-poll for a job
+# running in another process re-reads it (seconds)
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 0.25))
+
+class JobQueue:
+    """
+    Runs jobs on a bounded worker pool and records their state in a JobStore,
+    so a job can be polled through any worker process sharing the store.
+    Submissions are refused once max_pending jobs are queued or running in this process.
+    Finished jobs are forgotten ttl seconds after they complete.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, ttl: float, store: JobStore):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jobs')
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.store = store
+        self.pending = 0
+        # Completion events for jobs running in this process, so local long-polls wake immediately
+        self.done: Dict[str, threading.Event] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, fn: Callable[[], Dict[str, Any]]) -> Optional[str]:
+        """
+        Queue fn to run on the worker pool.
+        Returns the new job id, or None if the queue is full.
+        """
+        now = time.time()
+        self.store.purge(now - self.ttl)
+        with self.lock:
+            if self.pending >= self.max_pending:
+                return None
+            job_id = uuid.uuid4().hex
+            self.store.create(job_id, now)
+            self.pending += 1
+            self.done[job_id] = threading.Event()
+        self.executor.submit(self._run, job_id, fn)
+        return job_id
+
+    def _run(self, job_id: str, fn: Callable[[], Dict[str, Any]]) -> None:
+        try:
+            self.store.start(job_id)
+            try:
+                result = fn()
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {str(e)}")
+                self.store.finish(job_id, time.time(), error=str(e))
+            else:
+                self.store.finish(job_id, time.time(), result=result)
+        except Exception as e:
+            logger.error(f"Could not record the state of job {job_id}: {str(e)}")
+        finally:
+            with self.lock:
+                self.pending -= 1
+                done = self.done.pop(job_id)
+            done.set()
+
+    def get(self, job_id: str, wait: float = 0) -> Optional[Dict[str, Any]]:
+        """
+        Return a snapshot of a job's state, waiting up to wait seconds for it to finish.
+        Returns None if the job is unknown or has expired.
+        """
+        deadline = time.monotonic() + wait
+        job = self.store.get(job_id)
+        while job is not None and job['finished_at'] is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self.lock:
+                done = self.done.get(job_id)
+            if done is not None:
+                done.wait(remaining)
+            else:
+                # Running in another process; re-read the store until it finishes
+                time.sleep(min(JOB_POLL_INTERVAL, remaining))
+            job = self.store.get(job_id)
+        if job is not None and job['finished_at'] is not None and job['finished_at'] + self.ttl <= time.time():
+            return None
+        return job
+
+job_queue = JobQueue(JOB_MAX_WORKERS, JOB_MAX_PENDING, JOB_TTL, JobStore(JOB_DB_PATH))
+
+@jobs.route('/predict', methods=['POST'])
+def submit_predict() -> tuple[Dict[str, Any], int]:
+    """
+    Queue a /predict run and return its job id immediately.
+
+    Expected request format is the same as /predict:
+    {
+        "image": "https://...",
+        "fused": false
+    }
+
+    Returns:
+        202 with the job id and status URL, or 429 if the queue is full
+    """
+    if not request.is_json:
+        return jsonify({'error': 'Content-Type must be application/json'}), 400
+
+    data = request.get_json()
+    if not isinstance(data, dict) or 'image' not in data:
+        return jsonify({'error': 'Request must include an "image" URL'}), 400
+
+    image = data['image']
+    fused = data.get('fused')
+    job_id = job_queue.submit(lambda: Predictor(image, fused=fused).predict())
+    if job_id is None:
+        response = jsonify({'error': 'Too many pending jobs, retry later'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('jobs.get_job', job_id=job_id)
+    }), 202
+
+@jobs.route('/<job_id>', methods=['GET'])
+def get_job(job_id: str) -> tuple[Dict[str, Union[str, float, Dict, None]], int]:
+    """
+    Poll a job. Pass ?wait=<seconds> to long-poll until the job finishes (capped at JOB_MAX_WAIT).
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+
+    job = job_queue.get(job_id, wait)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+
+    job['timestamp'] = datetime.now().isoformat()
+    return jsonify(job), 200
@@ -0,0 +1,82 @@
+import json
+import sqlite3
+import threading
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class JobStore:
+    """
+    State of asynchronous jobs, kept in a SQLite file so every worker process
+    sharing the file can answer polls for jobs submitted to any of them.
+    If the file cannot be opened, jobs are kept in memory for this process only.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            self._conn = self._open(path)
+        except sqlite3.Error as e:
+            logger.warning(f"Could not open job store {path}, keeping jobs in memory only: {str(e)}")
+            self._conn = self._open(':memory:')
+
+    @staticmethod
+    def _open(path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        try:
+            if path != ':memory:':
+                # Let pollers in other processes read while a worker writes
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, result TEXT, error TEXT, "
+                "submitted_at REAL NOT NULL, finished_at REAL)"
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _write(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def create(self, job_id: str, submitted_at: float) -> None:
+        self._write("INSERT INTO jobs (id, status, submitted_at) VALUES (?, 'queued', ?)", (job_id, submitted_at))
+
+    def start(self, job_id: str) -> None:
+        self._write("UPDATE jobs SET status = 'running' WHERE id = ?", (job_id,))
+
+    def finish(self, job_id: str, finished_at: float, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> None:
+        """Record a finished job: 'done' with its result, or 'failed' with its error."""
+        status = 'failed' if error is not None else 'done'
+        self._write(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error, finished_at, job_id)
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, result, error, submitted_at, finished_at FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, status, result, error, submitted_at, finished_at = row
+        return {
+            'id': job_id,
+            'status': status,
+            'result': json.loads(result) if result is not None else None,
+            'error': error,
+            'submitted_at': submitted_at,
+            'finished_at': finished_at
+        }
+
+    def purge(self, finished_before: float) -> None:
+        """Forget jobs that finished before the given time."""
+        self._write("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (finished_before,))
@@ -0,0 +1,166 @@
+from flask import Blueprint, Response
+from contextlib import contextmanager
+import contextvars
+import os
+import time
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
+
+# Create blueprint for the Prometheus metrics endpoint
+metrics = Blueprint('metrics', __name__)
+
+# Latency buckets in seconds, from local lookups up to slow model calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upstream prices in USD per million tokens, used to estimate spend
+TOKEN_PRICES = {
+    ('gemini', 'prompt'): float(os.getenv('GEMINI_INPUT_PRICE_PER_MTOK', 0.10)),
+    ('gemini', 'completion'): float(os.getenv('GEMINI_OUTPUT_PRICE_PER_MTOK', 0.40)),
+    ('perplexity', 'prompt'): float(os.getenv('PERPLEXITY_INPUT_PRICE_PER_MTOK', 3.0)),
+    ('perplexity', 'completion'): float(os.getenv('PERPLEXITY_OUTPUT_PRICE_PER_MTOK', 15.0)),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    inner = ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs)
+    return '{' + inner + '}'
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> (bucket counts, sum, count)
+        self.values: Dict[Labels, Tuple[List[int], float, int]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+# A collector returns (name, help, type, labels, value) samples computed at scrape time,
+# e.g. hit/miss counters kept by the caches themselves
+Sample = Tuple[str, str, str, Dict[str, str], float]
+_collectors: List[Callable[[], List[Sample]]] = []
+
+Metric = TypeVar('Metric', Counter, Histogram)
+
+def register(metric: Metric) -> Metric:
+    """Add a metric owned by another module to the registry rendered at /metrics."""
+    _registry.append(metric)
+    return metric
+
+def register_collector(collector: Callable[[], List[Sample]]) -> None:
+    _collectors.append(collector)
+
+stage_seconds = Histogram('ecobite_stage_seconds', 'Time spent in each pipeline stage')
+request_seconds = Histogram('ecobite_http_request_seconds', 'Time to produce each HTTP response')
+upstream_calls = Counter('ecobite_upstream_calls_total', 'Calls made to upstream model APIs')
+upstream_tokens = Counter('ecobite_upstream_tokens_total', 'Tokens reported by upstream model APIs')
+upstream_cost = Counter('ecobite_upstream_cost_usd_total', 'Estimated upstream spend from token usage')
+cache_lookups = Counter('ecobite_cache_lookups_total', 'Cache lookups by cache and result')
+
+_registry = [stage_seconds, request_seconds, upstream_calls, upstream_tokens, upstream_cost, cache_lookups]
+
+# Per-request list of stage timings, present only when the client asked for a breakdown
+_request_timings: contextvars.ContextVar[Optional[List[Dict[str, Union[str, float]]]]] = \
+    contextvars.ContextVar('request_timings', default=None)
+
+def start_request_timings(enabled: bool) -> None:
+    """Start (or disable) collecting a timing breakdown for the current request."""
+    _request_timings.set([] if enabled else None)
+
+def request_timings() -> Optional[List[Dict[str, Union[str, float]]]]:
+    return _request_timings.get()
+
+def observe_stage(stage: str, seconds: float, **labels: str) -> None:
+    stage_seconds.observe(seconds, stage=stage, **labels)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append({'stage': stage, **labels, 'seconds': round(seconds, 4)})
+
+@contextmanager
+def timed(stage: str, **labels: str) -> Iterator[None]:
+    """Record how long the enclosed block takes under the given stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, **labels)
+
+def record_tokens(provider: str, prompt: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    """Count one upstream call for the named prompt and the tokens (and estimated cost) it reported."""
+    upstream_calls.inc(provider=provider, prompt=prompt)
+    for kind, tokens in (('prompt', prompt_tokens), ('completion', completion_tokens)):
+        if not tokens:
+            continue
+        upstream_tokens.inc(tokens, provider=provider, prompt=prompt, type=kind)
+        upstream_cost.inc(tokens * TOKEN_PRICES.get((provider, kind), 0.0) / 1_000_000, provider=provider)
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    cache_lookups.inc(cache=cache, result='hit' if hit else 'miss')
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    # Samples of one metric may come from several collectors but must be rendered together
+    collected: Dict[str, List[str]] = {}
+    for collector in _collectors:
+        for name, help, kind, labels, value in collector():
+            if name not in collected:
+                collected[name] = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            collected[name].append(f"{name}{_format_labels(_labels(labels))} {value}")
+    for samples in collected.values():
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+@metrics.route('/metrics', methods=['GET'])
+def prometheus_metrics() -> Response:
+    """
+    Expose latency histograms, upstream token/cost counters and cache statistics
+    in the Prometheus text format.
+    """
+    return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,184 @@
+import re
+from typing import Optional, Dict, List, Set, Tuple, FrozenSet
+
+# Words that carry no information about which food a name refers to
+STOPWORDS = frozenset({'a', 'an', 'and', 'or', 'of', 'the', 'in', 'with', 'type', 'etc'})
+
+# Credit for a query token matched outside the row's head
+TAIL_MATCH_WEIGHT = 0.8
+
+# Minimum trigram similarity for a misspelled token to count as a match
+TOKEN_SIMILARITY_THRESHOLD = 0.6
+
+# Largest score discount for row tokens the query leaves unmatched (all of them unmatched)
+UNMATCHED_TOKEN_PENALTY = 0.1
+
+# Rows that match the whole query must agree on density within this relative spread,
+# otherwise the query is ambiguous (e.g. "milk" vs "milk, powdered") and no match is returned
+DENSITY_AGREEMENT = 0.1
+
+_non_alnum = re.compile(r'[^a-z0-9]+')
+
+def _stem(token: str) -> str:
+    # Crude plural folding, applied identically to queries and reference names
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 4 and token.endswith('oes'):
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, strip punctuation, drop stopwords and fold plurals."""
+    words = _non_alnum.sub(' ', text.lower()).split()
+    return [_stem(word) for word in words if word not in STOPWORDS]
+
+def trigrams(text: str) -> FrozenSet[str]:
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def similarity(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    """Dice coefficient between two trigram sets."""
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+class ReferenceIndex:
+    """
+    Match index over the reference density table.
+
+    Reference names are tokenized into an inverted index, and every token in the
+    vocabulary is indexed by trigram so misspelled query tokens still find rows.
+    A row's score is the share of query tokens it covers, discounted by how much
+    of the row's head (the text before the first comma, e.g. "apple juice" in
+    "apple juice, canned or bottled") the query leaves unmatched. Query tokens
+    found only after the head earn partial credit.
+    """
+
+    def __init__(self, density_dict: Dict[str, float]):
+        self.names: List[str] = list(density_dict.keys())
+        self.densities: List[float] = [density_dict[name] for name in self.names]
+        self.row_tokens: List[FrozenSet[str]] = []
+        self.row_heads: List[FrozenSet[str]] = []
+        self.row_trigrams: List[FrozenSet[str]] = []
+        self.token_index: Dict[str, List[int]] = {}
+        self.vocab_trigrams: Dict[str, FrozenSet[str]] = {}
+        self.trigram_index: Dict[str, Set[str]] = {}
+        self.row_trigram_index: Dict[str, List[int]] = {}
+
+        for row, name in enumerate(self.names):
+            tokens = frozenset(tokenize(name))
+            self.row_tokens.append(tokens)
+            self.row_heads.append(frozenset(tokenize(name.split(',')[0])) or tokens)
+            self.row_trigrams.append(trigrams(' '.join(tokenize(name))))
+            for gram in self.row_trigrams[row]:
+                self.row_trigram_index.setdefault(gram, []).append(row)
+            for token in tokens:
+                self.token_index.setdefault(token, []).append(row)
+
+        for token in self.token_index:
+            grams = trigrams(token)
+            self.vocab_trigrams[token] = grams
+            for gram in grams:
+                self.trigram_index.setdefault(gram, set()).add(token)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _expand_token(self, token: str) -> Dict[str, float]:
+        """Map a query token to the vocabulary tokens it matches, with their similarity."""
+        if token in self.token_index:
+            return {token: 1.0}
+        grams = trigrams(token)
+        candidates = set()
+        for gram in grams:
+            candidates |= self.trigram_index.get(gram, set())
+        matches = {}
+        for candidate in candidates:
+            score = similarity(grams, self.vocab_trigrams[candidate])
+            if score >= TOKEN_SIMILARITY_THRESHOLD:
+                matches[candidate] = score
+        return matches
+
+    def _score_rows(self, query: str) -> List[Tuple[float, float, int, bool]]:
+        """
+        Return (score, full-name similarity, row, whether every query token matched)
+        for every row sharing a token with the query.
+        """
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+
+        expansions = [self._expand_token(token) for token in query_tokens]
+        candidates = set()
+        for expansion in expansions:
+            for token in expansion:
+                candidates.update(self.token_index[token])
+
+        query_grams = trigrams(' '.join(query_tokens))
+        scored = []
+        for row in candidates:
+            tokens = self.row_tokens[row]
+            head = self.row_heads[row]
+            covered = 0.0
+            matched = set()
+            for expansion in expansions:
+                best_token, best_score = None, 0.0
+                for token, score in expansion.items():
+                    if token in tokens and score > best_score:
+                        best_token, best_score = token, score
+                if best_token is not None:
+                    covered += best_score if best_token in head else best_score * TAIL_MATCH_WEIGHT
+                    matched.add(best_token)
+            coverage = covered / len(query_tokens)
+            head_precision = len(head & matched) / len(head)
+            unmatched = 1 - len(matched) / len(tokens)
+            score = coverage * (0.6 + 0.4 * head_precision) * (1 - UNMATCHED_TOKEN_PENALTY * unmatched)
+            complete = len(matched) == len(query_tokens)
+            scored.append((score, similarity(query_grams, self.row_trigrams[row]), row, complete))
+        return scored
+
+    def match(self, query: str, threshold: float) -> Optional[Tuple[str, float, float]]:
+        """
+        Find the best reference row for a query.
+        Returns a tuple of (reference_name, density, score), or None if no row scores at least
+        threshold, or if the rows matching the query disagree on density.
+        """
+        scored = self._score_rows(query)
+        if not scored:
+            return None
+        score, _, row, _ = max(scored)
+        if score < threshold:
+            return None
+
+        # A bare "egg" fits "eggs, powdered" as well as "egg, chicken, boiled"; only answer
+        # when every row the query fits would give about the same density
+        densities = [self.densities[other] for other_score, _, other, complete in scored
+                     if complete or other_score >= threshold]
+        if max(densities) > min(densities) * (1 + DENSITY_AGREEMENT):
+            return None
+        return self.names[row], self.densities[row], round(score, 3)
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float, float]]:
+        """
+        Return up to k reference rows most relevant to a query as (reference_name, density, score).
+        Rows sharing tokens with the query rank first; the rest are filled by trigram similarity.
+        """
+        ranked = sorted(self._score_rows(query), reverse=True)[:k]
+        results = [(self.names[row], self.densities[row], round(score, 3)) for score, _, row, _ in ranked]
+        if len(results) >= k:
+            return results
+
+        seen = {row for _, _, row, _ in ranked}
+        query_grams = trigrams(' '.join(tokenize(query)))
+        candidates = set()
+        for gram in query_grams:
+            candidates.update(self.row_trigram_index.get(gram, ()))
+        candidates -= seen
+        similar = sorted(
+            ((similarity(query_grams, self.row_trigrams[row]), row) for row in candidates),
+            reverse=True
+        )[:k - len(results)]
+        results.extend((self.names[row], self.densities[row], round(score, 3)) for score, row in similar)
+        return results
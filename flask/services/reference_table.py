@@ -0,0 +1,175 @@
+"""
+Precompiled form of the reference density CSV.
+
+Parsing the CSV needs pandas, which is slow to import, so the parsed table is
+compiled once into a compact artifact: a short JSON header, the food names
+joined by newlines, and the densities as a packed array of doubles. Workers
+load it with a single read. The CSV (and pandas) are only touched again when the
+artifact is missing or the CSV has changed.
+
+Compile ahead of time, e.g. in the container build, with:
+
+    python -m services.reference_table
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Resolve data files relative to the app root rather than the working directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+REFERENCE_CSV_PATH = os.getenv('REFERENCE_CSV_PATH', os.path.join(DATA_DIR, 'food_density_reference.csv'))
+REFERENCE_ARTIFACT_PATH = os.getenv('REFERENCE_ARTIFACT_PATH', os.path.join(DATA_DIR, 'food_density_reference.bin'))
+
+MAGIC = b'EBREF\x00\x00\x01'
+_header_size = struct.Struct('<I')
+_lock = threading.Lock()
+
+class ReferenceTable:
+    """Reference food names, in CSV order, with their densities in g/ml."""
+
+    def __init__(self, names: List[str], densities: array):
+        self.names = names
+        self.densities = densities
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def as_dict(self) -> Dict[str, float]:
+        return dict(zip(self.names, self.densities))
+
+    def reference_text(self) -> str:
+        return '\n'.join(f"{name}: {density} g/ml" for name, density in zip(self.names, self.densities))
+
+def _csv_fingerprint(csv_path: str) -> Dict[str, int]:
+    stat = os.stat(csv_path)
+    return {'csv_size': stat.st_size, 'csv_mtime_ns': stat.st_mtime_ns}
+
+def _csv_sha256(csv_path: str) -> str:
+    with open(csv_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def parse_csv(csv_path: str) -> ReferenceTable:
+    """
+    Parse the reference CSV. Category header rows (no density) are skipped and
+    ranges such as "0.56-0.72" are averaged.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    density_dict: Dict[str, float] = {}
+    for raw_name, raw_density in zip(df['Food name'], df['Density']):
+        # Skip empty rows or headers
+        if pd.isna(raw_name) or pd.isna(raw_density):
+            continue
+
+        food_name = str(raw_name).strip().strip('"').lower()
+        density_str = str(raw_density).strip()
+        if not food_name or food_name.endswith(','):
+            continue
+
+        try:
+            # Handle range values (e.g., "0.56-0.72")
+            if '-' in density_str:
+                low, high = map(float, density_str.split('-'))
+                density_dict[food_name] = (low + high) / 2
+            else:
+                density_dict[food_name] = float(density_str)
+        except (ValueError, TypeError) as e:
+            logger.debug(f"Failed to parse density for {food_name}: {str(e)}")
+
+    return ReferenceTable(list(density_dict.keys()), array('d', density_dict.values()))
+
+def write_artifact(table: ReferenceTable, artifact_path: str, source: Dict[str, object]) -> None:
+    names_blob = '\n'.join(table.names).encode('utf-8')
+    densities = array('d', table.densities)
+    if sys.byteorder != 'little':
+        densities.byteswap()
+    header = json.dumps({**source, 'count': len(table), 'names_bytes': len(names_blob)}).encode('utf-8')
+
+    # Write to a temporary name first so other workers never load a partial file
+    temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC + _header_size.pack(len(header)) + header + names_blob + densities.tobytes())
+    os.replace(temp_path, artifact_path)
+
+def read_artifact(artifact_path: str) -> Tuple[Dict[str, object], ReferenceTable]:
+    with open(artifact_path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{artifact_path} is not a compiled reference table")
+
+    offset = len(MAGIC)
+    (header_len,) = _header_size.unpack_from(data, offset)
+    offset += _header_size.size
+    header = json.loads(data[offset:offset + header_len])
+    offset += header_len
+    names_end = offset + header['names_bytes']
+    names = data[offset:names_end].decode('utf-8').split('\n') if header['count'] else []
+
+    densities = array('d')
+    densities.frombytes(data[names_end:names_end + header['count'] * densities.itemsize])
+    if sys.byteorder != 'little':
+        densities.byteswap()
+    if len(names) != header['count'] or len(densities) != header['count']:
+        raise ValueError(f"{artifact_path} is truncated")
+    return header, ReferenceTable(names, densities)
+
+def compile_reference(csv_path: str = REFERENCE_CSV_PATH, artifact_path: str = REFERENCE_ARTIFACT_PATH) -> ReferenceTable:
+    """Parse the CSV and write the artifact next to it."""
+    table = parse_csv(csv_path)
+    source = {**_csv_fingerprint(csv_path), 'csv_sha256': _csv_sha256(csv_path)}
+    try:
+        write_artifact(table, artifact_path, source)
+    except OSError as e:
+        # A read-only image can still serve from the parsed table
+        logger.warning(f"Could not write compiled reference table {artifact_path}: {str(e)}")
+    return table
+
+def _is_fresh(header: Dict[str, object], csv_path: str) -> bool:
+    try:
+        fingerprint = _csv_fingerprint(csv_path)
+    except OSError:
+        # No CSV shipped alongside the artifact; trust the artifact
+        return True
+    if all(header.get(key) == value for key, value in fingerprint.items()):
+        return True
+    # Timestamps change on checkout or copy; only rebuild if the content differs
+    return header.get('csv_sha256') == _csv_sha256(csv_path)
+
+def load_reference_table(csv_path: str = REFERENCE_CSV_PATH, artifact_path: str = REFERENCE_ARTIFACT_PATH) -> ReferenceTable:
+    """
+    Load the compiled reference table, compiling it from the CSV first if the
+    artifact is missing, unreadable or older than the CSV's contents.
+    """
+    start = time.perf_counter()
+    with _lock:
+        try:
+            header, table = read_artifact(artifact_path)
+            if _is_fresh(header, csv_path):
+                logger.info(f"Loaded {len(table)} reference densities from {artifact_path} "
+                            f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+                return table
+            logger.info(f"Compiled reference table {artifact_path} is stale, rebuilding")
+        except FileNotFoundError:
+            logger.info(f"No compiled reference table at {artifact_path}, building it")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read compiled reference table {artifact_path}: {str(e)}")
+
+        table = compile_reference(csv_path, artifact_path)
+        logger.info(f"Compiled {len(table)} reference densities from {csv_path} "
+                    f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return table
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    compiled = compile_reference()
+    print(f"Compiled {len(compiled)} reference densities into {REFERENCE_ARTIFACT_PATH}")
@@ -0,0 +1,482 @@
+"""
+Resumable bulk re-scoring of archived images.
+
+Streams a manifest of image URLs (CSV with an "image" or "url" column, or JSONL of
+{"image": ..., "id": ...} objects or bare strings), runs each image through
+Predictor with bounded concurrency and appends one result per row to a JSONL file
+or to Parquet part files. Progress is checkpointed, so a killed run picks up where
+it stopped when started again with the same arguments. Rows that fail because an
+upstream API is down or rate limiting are not checkpointed, so the next run retries
+them, and no new rows are started while an upstream circuit breaker is open.
+
+Run from the flask directory:
+
+    python -m services.rescore manifest.csv results.jsonl --concurrency 16
+    python -m services.rescore manifest.jsonl results/ --format parquet
+
+The Gemini upload, result and density caches are all used as in the app, so
+images whose analysis is still valid for the current model and prompts cost
+nothing, and repeated URLs in the manifest are only scored once.
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import OrderedDict
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Save the checkpoint at least this often (seconds) while results keep arriving
+CHECKPOINT_INTERVAL = 10.0
+
+# Log throughput this often (seconds)
+PROGRESS_INTERVAL = 30.0
+
+# How often to re-check an open circuit breaker before submitting more rows (seconds)
+BREAKER_POLL_INTERVAL = 1.0
+
+Record = Dict[str, Any]
+
+# Parquet columns and their pyarrow types
+PARQUET_COLUMNS = (
+    ('index', 'int64'), ('id', 'string'), ('image', 'string'), ('error', 'string'),
+    ('mode', 'string'), ('model', 'string'), ('cached', 'bool_'), ('response', 'string'),
+    ('sources', 'string'), ('image_stats', 'string'), ('near_duplicate', 'string'),
+)
+
+def read_manifest(path: str) -> Iterator[Tuple[int, Record]]:
+    """Yield (index, {"image", "id"}) for each manifest row without loading the whole file."""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            reader = csv.DictReader(f)
+            column = next((name for name in ('image', 'url', 'image_url') if name in (reader.fieldnames or [])), None)
+            if column is None:
+                raise ValueError(f"{path} needs an image, url or image_url column")
+            for index, row in enumerate(reader):
+                yield index, {'image': (row.get(column) or '').strip(), 'id': row.get('id')}
+            return
+
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, str):
+                entry = {'image': entry}
+            yield index, {'image': entry.get('image') or entry.get('url'), 'id': entry.get('id')}
+            index += 1
+
+class Checkpoint:
+    """
+    Tracks which manifest rows are durably written: every row below `next_index`,
+    plus the rows above it that finished out of order.
+    """
+
+    def __init__(self, path: str, manifest: str):
+        self.path = path
+        self.manifest = os.path.abspath(manifest)
+        self.next_index = 0
+        self.done: Set[int] = set()
+        self.completed = 0
+        self.errors = 0
+        # Rows this run left unwritten after transient upstream failures; never saved
+        self.deferred = 0
+
+    def load(self) -> bool:
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        if state.get('manifest') != self.manifest:
+            raise ValueError(f"Checkpoint {self.path} belongs to {state.get('manifest')}, not {self.manifest}")
+        self.next_index = state['next_index']
+        self.done = set(state.get('done', []))
+        self.completed = state.get('completed', 0)
+        self.errors = state.get('errors', 0)
+        return True
+
+    def mark(self, indexes: List[int]) -> None:
+        self.done.update(indexes)
+        while self.next_index in self.done:
+            self.done.remove(self.next_index)
+            self.next_index += 1
+
+    def is_done(self, index: int) -> bool:
+        return index < self.next_index or index in self.done
+
+    def save(self) -> None:
+        state = {
+            'manifest': self.manifest,
+            'next_index': self.next_index,
+            'done': sorted(self.done),
+            'completed': self.completed,
+            'errors': self.errors,
+            'updated_at': time.time()
+        }
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+
+class JsonlWriter:
+    """Appends one JSON line per result; a row is durable as soon as it is written."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._drop_partial_line()
+        self.file = open(path, 'a')
+
+    def _drop_partial_line(self) -> None:
+        # A run killed mid-write can leave a truncated last line
+        try:
+            with open(self.path, 'rb+') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                if size == 0:
+                    return
+                f.seek(size - 1)
+                if f.read(1) == b'\n':
+                    return
+                position = size
+                while position > 0:
+                    step = min(4096, position)
+                    f.seek(position - step)
+                    chunk = f.read(step)
+                    newline = chunk.rfind(b'\n')
+                    if newline != -1:
+                        f.truncate(position - step + newline + 1)
+                        return
+                    position -= step
+                f.truncate(0)
+        except FileNotFoundError:
+            return
+
+    def written_since(self, first_index: int) -> Set[int]:
+        """Indexes at or above first_index already in the output, e.g. written after the last checkpoint."""
+        indexes = set()
+        if not os.path.exists(self.path):
+            return indexes
+        with open(self.path) as f:
+            for line in f:
+                index = json.loads(line).get('index', -1)
+                if index >= first_index:
+                    indexes.add(index)
+        return indexes
+
+    def add(self, result: Record) -> List[int]:
+        self.file.write(json.dumps(result) + '\n')
+        self.file.flush()
+        return [result['index']]
+
+    def flush(self) -> List[int]:
+        return []
+
+    def close(self) -> None:
+        self.file.close()
+
+class ParquetWriter:
+    """
+    Buffers results and writes them as numbered Parquet part files in a directory.
+    Rows only count as durable once their part file is complete.
+    """
+
+    def __init__(self, directory: str, rows_per_file: int):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow; install it or write JSONL instead")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = directory
+        self.rows_per_file = rows_per_file
+        self.buffer: List[Record] = []
+        os.makedirs(directory, exist_ok=True)
+        self.part = len([name for name in os.listdir(directory) if name.endswith('.parquet')])
+
+    def written_since(self, first_index: int) -> Set[int]:
+        indexes = set()
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.parquet'):
+                column = self.pq.read_table(os.path.join(self.directory, name), columns=['index'])['index']
+                indexes.update(index for index in column.to_pylist() if index >= first_index)
+        return indexes
+
+    def add(self, result: Record) -> List[int]:
+        self.buffer.append(result)
+        if len(self.buffer) >= self.rows_per_file:
+            return self.flush()
+        return []
+
+    def flush(self) -> List[int]:
+        if not self.buffer:
+            return []
+        # Every part file shares one schema; nested fields are stored as JSON text
+        rows = []
+        for result in self.buffer:
+            row = {}
+            for column, kind in PARQUET_COLUMNS:
+                value = result.get(column)
+                if value is not None and kind == 'string' and not isinstance(value, str):
+                    value = json.dumps(value)
+                row[column] = value
+            rows.append(row)
+        schema = self.pa.schema([(column, getattr(self.pa, kind)()) for column, kind in PARQUET_COLUMNS])
+        table = self.pa.Table.from_pylist(rows, schema=schema)
+        name = f"part-{self.part:05d}.parquet"
+        # Readers skip dot-files, so a part interrupted mid-write is never picked up
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        self.pq.write_table(table, temp_path)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        self.part += 1
+        indexes = [result['index'] for result in self.buffer]
+        self.buffer = []
+        return indexes
+
+    def close(self) -> None:
+        self.flush()
+
+class Scorer:
+    """
+    Scores images with Predictor. Repeated URLs are served from a bounded LRU of recent
+    results, and a URL already being scored is waited on rather than scored twice.
+    """
+
+    def __init__(self, fused: Optional[bool], dedupe_size: int):
+        from ai.predictor import Predictor, MODEL
+        self.predictor_class = Predictor
+        self.model = MODEL
+        self.fused = fused
+        self.dedupe_size = dedupe_size
+        self.recent: 'OrderedDict[str, Record]' = OrderedDict()
+        self.in_flight: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def score(self, image: str) -> Record:
+        with self.lock:
+            if image in self.recent:
+                self.recent.move_to_end(image)
+                self.duplicates += 1
+                return self.recent[image]
+            future = self.in_flight.get(image)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[image] = future
+            else:
+                self.duplicates += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = self.predictor_class(image, fused=self.fused).predict()
+            result['model'] = self.model
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(image, None)
+        with self.lock:
+            if self.dedupe_size > 0:
+                self.recent[image] = result
+                while len(self.recent) > self.dedupe_size:
+                    self.recent.popitem(last=False)
+        future.set_result(result)
+        return result
+
+class UpstreamUnavailableError(RuntimeError):
+    """Raised when the upstream APIs stay unavailable for longer than the run is willing to wait."""
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a failure says nothing about the image and is worth retrying on a later run."""
+    from . import upstream
+    return isinstance(error, upstream.UpstreamError) or upstream.is_retryable(error)
+
+def process_row(scorer: Scorer, index: int, record: Record) -> Record:
+    """
+    Score one manifest row. Failures are returned as an "error" row; transient ones are
+    also flagged "retry", and the caller leaves those rows unwritten for the next run.
+    """
+    base = {'index': index, 'id': record.get('id'), 'image': record.get('image')}
+    if not record.get('image'):
+        return {**base, 'error': 'Missing image URL'}
+    try:
+        return {**base, **scorer.score(record['image'])}
+    except Exception as e:
+        if is_transient(e):
+            logger.warning(f"Re-scoring row {index} ({record['image']}) failed transiently, leaving it for the next run: {str(e)}")
+            return {**base, 'error': str(e), 'retry': True}
+        logger.error(f"Re-scoring failed for row {index} ({record['image']}): {str(e)}")
+        return {**base, 'error': str(e)}
+
+def run(manifest: str, output: str, output_format: str = 'jsonl', concurrency: int = 8,
+        window: Optional[int] = None, dedupe_size: int = 10000, fused: Optional[bool] = None,
+        rows_per_file: int = 1000, checkpoint_path: Optional[str] = None, restart: bool = False,
+        max_outage: float = 600.0) -> Checkpoint:
+    """
+    Re-score every row of the manifest not already recorded in the checkpoint.
+    At most `concurrency` rows run at once, and no row is started more than `window`
+    rows past the oldest one still running, which bounds the out-of-order state kept.
+
+    Rows that fail transiently (upstream outages, rate limits, timeouts) are not written
+    or checkpointed, so the next run retries them. While an upstream circuit breaker is
+    open no new rows are started; if no row has reached the APIs for `max_outage`
+    seconds, the run stops with UpstreamUnavailableError.
+    """
+    from . import upstream
+
+    window = window or concurrency * 16
+    checkpoint_path = checkpoint_path or f"{output.rstrip(os.sep)}.checkpoint.json"
+    if restart:
+        stale = [checkpoint_path]
+        if output_format == 'jsonl':
+            stale.append(output)
+        elif os.path.isdir(output):
+            stale.extend(os.path.join(output, name) for name in os.listdir(output) if name.endswith('.parquet'))
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
+
+    writer = JsonlWriter(output) if output_format == 'jsonl' else ParquetWriter(output, rows_per_file)
+    checkpoint = Checkpoint(checkpoint_path, manifest)
+    resuming = checkpoint.load()
+    # Rows written after the last checkpoint save (or before the first) are already in the output
+    recovered = writer.written_since(checkpoint.next_index) - checkpoint.done
+    checkpoint.completed += len(recovered)
+    checkpoint.mark(list(recovered))
+    if resuming or recovered:
+        logger.info(f"Resuming {manifest} at row {checkpoint.next_index} "
+                    f"({checkpoint.completed} rows done, {len(recovered)} recovered from the output)")
+    checkpoint.save()
+
+    scorer = Scorer(fused, dedupe_size)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='rescore')
+    pending: Dict[Future, int] = {}
+    started = time.monotonic()
+    last_save = last_progress = last_reached = started
+    completed_this_run = 0
+
+    def collect(timeout: Optional[float] = None) -> None:
+        nonlocal last_save, last_progress, last_reached, completed_this_run
+        if not pending:
+            return
+        done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.pop(future)
+            result = future.result()
+            if result.pop('retry', False):
+                checkpoint.deferred += 1
+                continue
+            last_reached = time.monotonic()
+            checkpoint.completed += 1
+            checkpoint.errors += 'error' in result
+            completed_this_run += 1
+            checkpoint.mark(writer.add(result))
+
+        now = time.monotonic()
+        if now - last_save >= CHECKPOINT_INTERVAL:
+            checkpoint.save()
+            last_save = now
+        if now - last_progress >= PROGRESS_INTERVAL:
+            rate = completed_this_run / (now - started)
+            logger.info(f"{checkpoint.completed} rows done ({checkpoint.errors} errors, "
+                        f"{checkpoint.deferred} deferred, {scorer.duplicates} duplicates), "
+                        f"{rate:.2f} rows/s, next row {checkpoint.next_index}")
+            last_progress = now
+
+    def wait_for_upstream() -> None:
+        # Every row would fail fast while a breaker is open; hold new rows back until it lets a probe through
+        paused = False
+        while upstream.gemini.breaker.rejecting() or upstream.perplexity.breaker.rejecting():
+            if time.monotonic() - last_reached >= max_outage:
+                raise UpstreamUnavailableError(
+                    f"Upstream APIs unavailable for {max_outage:.0f}s; run the same command again to resume")
+            if not paused:
+                logger.warning("Upstream circuit breaker is open, pausing new rows")
+                paused = True
+            if pending:
+                collect(BREAKER_POLL_INTERVAL)
+            else:
+                time.sleep(BREAKER_POLL_INTERVAL)
+        if paused:
+            logger.info("Upstream circuit breaker is letting calls through again, resuming")
+
+    try:
+        for index, record in read_manifest(manifest):
+            if checkpoint.is_done(index):
+                continue
+            while len(pending) >= concurrency or (pending and index - min(pending.values()) >= window):
+                collect()
+            wait_for_upstream()
+            pending[executor.submit(process_row, scorer, index, record)] = index
+        while pending:
+            collect()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        checkpoint.mark(writer.flush())
+        writer.close()
+        checkpoint.save()
+
+    logger.info(f"Finished {manifest}: {checkpoint.completed} rows ({checkpoint.errors} errors, "
+                f"{scorer.duplicates} duplicate URLs) in {time.monotonic() - started:.1f}s")
+    if checkpoint.deferred:
+        logger.warning(f"{checkpoint.deferred} rows failed transiently and were left for the next run")
+    return checkpoint
+
+def main(argv: Optional[List[str]] = None) -> int:
+    # API keys and cache settings come from .env like in the app, and are read when
+    # Scorer first imports ai.predictor, so load them before anything else
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='CSV or JSONL file of image URLs')
+    parser.add_argument('output', help='JSONL file, or directory of Parquet part files')
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl')
+    parser.add_argument('--concurrency', type=int, default=8, help='images scored at once (default: %(default)s)')
+    parser.add_argument('--window', type=int, default=None,
+                        help='furthest a row may start past the oldest running one (default: 16 x concurrency)')
+    parser.add_argument('--dedupe-size', type=int, default=10000,
+                        help='recent URLs remembered for deduplication (default: %(default)s)')
+    parser.add_argument('--fused', action='store_true', default=None, help='use the fused single-call prediction mode')
+    parser.add_argument('--rows-per-file', type=int, default=1000, help='rows per Parquet part file (default: %(default)s)')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint path (default: <output>.checkpoint.json)')
+    parser.add_argument('--restart', action='store_true', help='discard the checkpoint and earlier output and start over')
+    parser.add_argument('--max-outage', type=float, default=600.0,
+                        help='seconds to wait out an upstream outage before stopping (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        checkpoint = run(
+            args.manifest, args.output, output_format=args.format, concurrency=args.concurrency,
+            window=args.window, dedupe_size=args.dedupe_size, fused=args.fused,
+            rows_per_file=args.rows_per_file, checkpoint_path=args.checkpoint, restart=args.restart,
+            max_outage=args.max_outage
+        )
+    except KeyboardInterrupt:
+        print('Interrupted; run the same command again to resume.', file=sys.stderr)
+        return 130
+    except UpstreamUnavailableError as e:
+        print(str(e), file=sys.stderr)
+        return 75  # EX_TEMPFAIL
+    except (ValueError, RuntimeError) as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    if checkpoint.deferred:
+        return 75  # EX_TEMPFAIL: rerun to retry the deferred rows
+    return 1 if checkpoint.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, TypeVar
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Status codes worth retrying; 429 and 503 also mean the provider wants less concurrency
+RETRYABLE_STATUS = frozenset({408, 409, 425, 429, 500, 502, 503, 504})
+OVERLOAD_STATUS = frozenset({429, 503})
+
+# Longest Retry-After (seconds) we are willing to honour inside a request
+MAX_RETRY_AFTER = 10.0
+
+class UpstreamError(Exception):
+    """Raised when a call is refused locally, before reaching the provider."""
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+class UpstreamSaturatedError(UpstreamError):
+    pass
+
+def status_code(error: BaseException) -> Optional[int]:
+    """Pull an HTTP status out of google-genai (.code) or OpenAI (.status_code) errors."""
+    for attribute in ('status_code', 'code'):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, 'response', None)
+    value = getattr(response, 'status_code', None)
+    return value if isinstance(value, int) else None
+
+def is_transport_error(error: BaseException) -> bool:
+    # SDK timeout/connection errors share no base class, but all say what they are in their name
+    return isinstance(error, (TimeoutError, ConnectionError)) or any(
+        'Timeout' in cls.__name__ or 'Connection' in cls.__name__ for cls in type(error).__mro__
+    )
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, UpstreamError):
+        return False
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    return is_transport_error(error)
+
+def retry_after(error: BaseException) -> Optional[float]:
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        return min(float(headers.get('retry-after')), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit. Each fast success grows the limit by 1/limit (about one
+    slot per round of calls); an overload response or a call slower than the latency
+    target shrinks it multiplicatively, at most once per cooldown so a single burst
+    of 429s doesn't collapse it to the minimum.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float,
+                 backoff: float = 0.5, cooldown: float = 1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def try_acquire(self) -> bool:
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: Optional[float], overloaded: bool = False) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            slow = latency is not None and self.latency_target > 0 and latency > self.latency_target
+            if overloaded or slow:
+                if now - self.last_decrease >= self.cooldown:
+                    factor = self.backoff if overloaded else 0.9
+                    self.limit = max(self.minimum, self.limit * factor)
+                    self.last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and fails calls fast for `reset_timeout`
+    seconds, then lets a single probe through (half-open) to decide whether to close.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_thread: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def rejecting(self) -> bool:
+        """Whether allow() would refuse right now; lets callers fail fast without changing state."""
+        if self.threshold <= 0:
+            return False
+        with self.lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at < self.reset_timeout
+            return self.state == self.HALF_OPEN and self.probing
+
+    def allow(self) -> bool:
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                self.probe_thread = threading.get_ident()
+                return True
+            return False
+
+    def end_probe(self) -> None:
+        """Give up this thread's probe if it ended without an outcome, so another call can probe."""
+        with self.lock:
+            if self.probing and self.probe_thread == threading.get_ident():
+                self.probing = False
+                self.probe_thread = None
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.threshold > 0 and self.failures >= self.threshold):
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit opened after {self.failures} consecutive upstream failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+class Upstream:
+    """
+    Guards calls to one provider: an adaptive concurrency limit, bounded retries with
+    full-jitter backoff, a circuit breaker and, optionally, hedging, where a second
+    copy of a call is started once the first has run longer than a recent latency
+    percentile and whichever finishes first wins.
+    """
+
+    def __init__(self, name: str, max_concurrency: int = 16, min_concurrency: int = 1,
+                 initial_concurrency: Optional[int] = None, latency_target: float = 0.0,
+                 max_retries: int = 2, backoff_base: float = 0.25, backoff_cap: float = 4.0,
+                 queue_timeout: float = 30.0, breaker_threshold: int = 5, breaker_reset: float = 15.0,
+                 hedge_percentile: float = 0.0, hedge_min_samples: int = 20):
+        self.name = name
+        self.limit = AdaptiveLimit(initial_concurrency or max_concurrency, min_concurrency,
+                                   max_concurrency, latency_target)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.queue_timeout = queue_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies: Deque[float] = deque(maxlen=256)
+        self.latency_lock = threading.Lock()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=max_concurrency * 2,
+                                                 thread_name_prefix=f"{name}-hedge") if hedge_percentile > 0 else None
+
+    @classmethod
+    def from_env(cls, name: str, **defaults: Any) -> 'Upstream':
+        """Build an Upstream, letting <NAME>_<SETTING> environment variables override the defaults."""
+        settings = dict(defaults)
+        for key, value in defaults.items():
+            raw = os.getenv(f"{name.upper()}_{key.upper()}")
+            if raw is not None:
+                settings[key] = type(value)(raw)
+        return cls(name, **settings)
+
+    def call(self, fn: Callable[[], T], hedge: bool = True) -> T:
+        """
+        Run fn (a zero-argument callable making one upstream request) under this provider's
+        guards. Pass hedge=False for calls that must not be duplicated.
+        """
+        attempt = 0
+        while True:
+            try:
+                if hedge and self.hedge_executor is not None:
+                    return self._hedged(fn)
+                return self._attempt(fn)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                attempt += 1
+                upstream_retries.inc(provider=self.name)
+                logger.info(f"Retrying {self.name} call in {delay:.2f}s (attempt {attempt}): {str(e)}")
+                time.sleep(delay)
+
+    def _attempt(self, fn: Callable[[], T], acquired: bool = False) -> T:
+        # Fail fast while the circuit is open rather than queueing for a slot first
+        if self.breaker.rejecting():
+            if acquired:
+                self.limit.release(None)
+            upstream_attempts.inc(provider=self.name, outcome='circuit_open')
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        if not acquired and not self.limit.acquire(self.queue_timeout):
+            upstream_attempts.inc(provider=self.name, outcome='saturated')
+            raise UpstreamSaturatedError(f"Timed out waiting for a {self.name} concurrency slot")
+        # Only take the half-open probe once holding a slot, so a probe can't be lost to a queue timeout
+        if not self.breaker.allow():
+            self.limit.release(None)
+            upstream_attempts.inc(provider=self.name, outcome='circuit_open')
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+        try:
+            return self._run(fn)
+        finally:
+            self.breaker.end_probe()
+
+    def _run(self, fn: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            code = status_code(e)
+            overloaded = code in OVERLOAD_STATUS
+            self.limit.release(None, overloaded=overloaded)
+            # Client errors such as a bad prompt show the provider is up
+            if is_retryable(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            upstream_attempts.inc(provider=self.name, outcome='overloaded' if overloaded else 'error')
+            raise
+        latency = time.perf_counter() - start
+        self.limit.release(latency)
+        self.breaker.record_success()
+        with self.latency_lock:
+            self.latencies.append(latency)
+        upstream_attempts.inc(provider=self.name, outcome='success')
+        upstream_attempt_seconds.observe(latency, provider=self.name)
+        return result
+
+    def hedge_delay(self) -> Optional[float]:
+        with self.latency_lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def _hedged(self, fn: Callable[[], T]) -> T:
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._attempt(fn)
+
+        primary = self.hedge_executor.submit(contextvars.copy_context().run, self._attempt, fn)
+        done, _ = wait([primary], timeout=delay)
+        # Only hedge with spare capacity; a hedge must never queue behind real traffic
+        if done or self.breaker.state != CircuitBreaker.CLOSED or not self.limit.try_acquire():
+            return primary.result()
+
+        upstream_hedges.inc(provider=self.name, result='launched')
+        hedge = self.hedge_executor.submit(contextvars.copy_context().run, self._attempt, fn, True)
+        pending = {primary, hedge}
+        first_error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is hedge:
+                        upstream_hedges.inc(provider=self.name, result='won')
+                    return future.result()
+                first_error = first_error or error
+        raise first_error
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'concurrency_limit': self.limit.limit,
+            'in_flight': self.limit.in_flight,
+            'circuit_state': self.breaker.state,
+        }
+
+upstream_attempts = metrics.register(metrics.Counter(
+    'ecobite_upstream_attempts_total', 'Upstream call attempts by provider and outcome'))
+upstream_retries = metrics.register(metrics.Counter(
+    'ecobite_upstream_retries_total', 'Upstream calls retried after a transient failure'))
+upstream_hedges = metrics.register(metrics.Counter(
+    'ecobite_upstream_hedges_total', 'Hedged upstream calls launched, and how many beat the original'))
+upstream_attempt_seconds = metrics.register(metrics.Histogram(
+    'ecobite_upstream_attempt_seconds', 'Latency of successful upstream call attempts'))
+
+# One guard per provider; override any setting with e.g. GEMINI_MAX_CONCURRENCY or PERPLEXITY_HEDGE_PERCENTILE
+gemini = Upstream.from_env(
+    'gemini', max_concurrency=32, min_concurrency=2, latency_target=20.0,
+    max_retries=2, queue_timeout=30.0, breaker_threshold=5, breaker_reset=15.0, hedge_percentile=0.0
+)
+perplexity = Upstream.from_env(
+    'perplexity', max_concurrency=16, min_concurrency=1, latency_target=15.0,
+    max_retries=2, queue_timeout=30.0, breaker_threshold=5, breaker_reset=15.0, hedge_percentile=0.0
+)
+
+def collect_upstream_metrics() -> List[metrics.Sample]:
+    samples: List[metrics.Sample] = []
+    for upstream in (gemini, perplexity):
+        stats = upstream.stats()
+        labels = {'provider': upstream.name}
+        samples.append(('ecobite_upstream_concurrency_limit', 'Current adaptive concurrency limit', 'gauge', labels, stats['concurrency_limit']))
+        samples.append(('ecobite_upstream_in_flight', 'Upstream calls currently in flight', 'gauge', labels, stats['in_flight']))
+        samples.append(('ecobite_upstream_circuit_state', 'Circuit breaker state (0 closed, 1 open, 2 half-open)', 'gauge', labels, stats['circuit_state']))
+    return samples
+
+metrics.register_collector(collect_upstream_metrics)
@@ -0,0 +1,16 @@
+from bench.run import percentile
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 95) == 95.0
+    assert percentile(values, 99) == 99.0
+    assert percentile(values, 100) == 100.0
+
+
+def test_percentile_small_samples():
+    assert percentile([], 95) == 0.0
+    assert percentile([1.0], 50) == 1.0
+    assert percentile([1.0, 2.0], 50) == 1.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 0) == 1.0
@@ -0,0 +1,24 @@
+import os
+
+from services.density_cache import DensityCache
+
+
+def test_entries_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'densities.sqlite3')
+    cache = DensityCache(path, ttl=60, negative_ttl=60)
+    cache.set('Rice', 0.85)
+    cache.set('mystery', None)
+
+    reloaded = DensityCache(path, ttl=60, negative_ttl=60)
+    assert reloaded.get('rice') == (True, 0.85)
+    assert reloaded.get('Mystery') == (True, None)
+    assert reloaded.get('bread') == (False, None)
+
+
+def test_unopenable_path_falls_back_to_memory(tmp_path):
+    path = str(tmp_path / 'missing' / 'densities.sqlite3')
+    cache = DensityCache(path, ttl=60, negative_ttl=60)
+    cache.set('rice', 0.85)
+
+    assert cache.get('rice') == (True, 0.85)
+    assert not os.path.exists(path)
@@ -0,0 +1,46 @@
+import os
+import threading
+
+# Keep the module-level queue from creating a store under data/
+os.environ.setdefault('JOB_DB_PATH', ':memory:')
+
+from services.job_service import JobQueue
+from services.job_store import JobStore
+
+
+def test_job_is_visible_from_another_process(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    release = threading.Event()
+    # Two queues over one file stand in for two worker processes
+    worker = JobQueue(max_workers=1, max_pending=4, ttl=60, store=JobStore(path))
+    poller = JobQueue(max_workers=1, max_pending=4, ttl=60, store=JobStore(path))
+
+    job_id = worker.submit(lambda: release.wait(5) and {'response': {'rice': 120.0}})
+    assert poller.get(job_id)['status'] in ('queued', 'running')
+
+    release.set()
+    job = poller.get(job_id, wait=5)
+    assert job['status'] == 'done'
+    assert job['result'] == {'response': {'rice': 120.0}}
+
+
+def test_failed_job_and_unknown_job(tmp_path):
+    queue = JobQueue(max_workers=1, max_pending=4, ttl=60, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+
+    def fail():
+        raise ValueError('bad image')
+
+    job = queue.get(queue.submit(fail), wait=5)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'bad image'
+    assert queue.get('missing') is None
+
+
+def test_full_queue_refuses_submissions(tmp_path):
+    release = threading.Event()
+    queue = JobQueue(max_workers=1, max_pending=1, ttl=60, store=JobStore(str(tmp_path / 'jobs.sqlite3')))
+
+    job_id = queue.submit(lambda: release.wait(5) and {})
+    assert queue.submit(lambda: {}) is None
+    release.set()
+    assert queue.get(job_id, wait=5)['status'] == 'done'
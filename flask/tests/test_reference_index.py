@@ -0,0 +1,50 @@
+import pytest
+
+from services.reference_index import ReferenceIndex
+from services.reference_table import load_reference_table
+
+THRESHOLD = 0.85
+
+
+@pytest.fixture(scope='module')
+def index():
+    return ReferenceIndex(load_reference_table().as_dict())
+
+
+@pytest.mark.parametrize('query', ['egg', 'Egg', 'eggs', 'beef', 'milk', 'whole milk'])
+def test_ambiguous_queries_do_not_match(index, query):
+    # Rows such as "eggs, powdered" or "milk, buttermilk" must not stand in for the plain food
+    assert index.match(query, THRESHOLD) is None
+
+
+@pytest.mark.parametrize('query', ['apple juice', 'Apple Juice', 'apple juices'])
+def test_apple_juice_matches_its_row(index, query):
+    name, density, score = index.match(query, THRESHOLD)
+    assert name.startswith('apple juice, canned or bottled')
+    assert density == 1.04
+    assert score >= THRESHOLD
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('boiled rice', 'rice, boiled'),
+    ('goat milk', 'milk, goat, whole'),
+    ('beef stew', 'beef stew, canned'),
+    ('egg drop soup', 'egg drop soup'),
+    ('orange juice', 'orange juice'),
+])
+def test_intended_hits(index, query, expected):
+    assert index.match(query, THRESHOLD)[0] == expected
+
+
+def test_unmatched_row_tokens_lower_the_score():
+    index = ReferenceIndex({'egg, boiled, sliced, salted': 0.6, 'egg, boiled': 0.6})
+    scores = {name: score for name, _, score in index.search('boiled egg', 2)}
+    assert scores['egg, boiled, sliced, salted'] < scores['egg, boiled']
+    assert index.match('boiled egg', THRESHOLD)[0] == 'egg, boiled'
+
+
+def test_rows_disagreeing_on_density_are_rejected():
+    index = ReferenceIndex({'egg, boiled': 0.6, 'eggs, powdered': 0.35})
+    assert index.match('egg', THRESHOLD) is None
+    agreeing = ReferenceIndex({'egg, boiled': 0.6, 'egg, poached': 0.62})
+    assert agreeing.match('egg', THRESHOLD)[1] in (0.6, 0.62)
@@ -0,0 +1,31 @@
+from services.rescore import process_row
+from services.upstream import CircuitOpenError
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class FailingScorer:
+    def __init__(self, error):
+        self.error = error
+
+    def score(self, image):
+        raise self.error
+
+
+def test_upstream_failures_are_left_for_the_next_run():
+    for error in (StatusError(503), StatusError(429), TimeoutError('timed out'), CircuitOpenError('open')):
+        result = process_row(FailingScorer(error), 3, {'image': 'https://example.com/a.png', 'id': 'a'})
+        assert result['retry'] is True
+        assert result['index'] == 3
+
+
+def test_permanent_failures_are_recorded():
+    result = process_row(FailingScorer(StatusError(404)), 3, {'image': 'https://example.com/a.png', 'id': 'a'})
+    assert 'retry' not in result
+    assert result['error'] == 'status 404'
+    assert 'retry' not in process_row(FailingScorer(ValueError('bad json')), 4, {'image': 'x'})
+    assert process_row(None, 5, {'image': ''})['error'] == 'Missing image URL'
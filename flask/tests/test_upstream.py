@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+from services.upstream import AdaptiveLimit, CircuitBreaker, CircuitOpenError, Upstream, UpstreamSaturatedError
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def failing(status_code):
+    def fn():
+        raise StatusError(status_code)
+    return fn
+
+
+def test_saturated_probe_does_not_wedge_breaker():
+    upstream = Upstream('t', max_concurrency=1, max_retries=0, breaker_threshold=1,
+                        breaker_reset=0.1, queue_timeout=0.2)
+    with pytest.raises(StatusError):
+        upstream.call(failing(503))
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        upstream.call(lambda: 'ok')
+
+    # A hung call holds the only slot while the circuit goes half-open
+    assert upstream.limit.acquire(1)
+    time.sleep(0.15)
+    with pytest.raises(UpstreamSaturatedError):
+        upstream.call(lambda: 'ok')
+    assert not upstream.breaker.probing
+
+    upstream.limit.release(None)
+    assert upstream.call(lambda: 'ok') == 'ok'
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_probe_reopens_and_next_probe_recovers():
+    upstream = Upstream('t', max_concurrency=2, max_retries=0, breaker_threshold=1, breaker_reset=0.05)
+    with pytest.raises(StatusError):
+        upstream.call(failing(500))
+    time.sleep(0.06)
+    with pytest.raises(StatusError):
+        upstream.call(failing(500))
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.06)
+    assert upstream.call(lambda: 'ok') == 'ok'
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_adaptive_limit_backs_off_on_overload_and_grows_on_success():
+    limit = AdaptiveLimit(initial=8, minimum=1, maximum=16, latency_target=1.0, cooldown=60)
+    assert limit.acquire(0)
+    limit.release(None, overloaded=True)
+    assert limit.limit == 4
+    # Further overloads inside the cooldown don't shrink it again
+    assert limit.acquire(0)
+    limit.release(None, overloaded=True)
+    assert limit.limit == 4
+
+    for _ in range(4):
+        assert limit.acquire(0)
+        limit.release(0.01)
+    assert 4.9 < limit.limit < 5.1
+
+    # A call slower than the target counts as a sign of overload
+    limit.last_decrease = 0.0
+    assert limit.acquire(0)
+    limit.release(2.0)
+    assert limit.limit < 4.9
+
+
+def test_adaptive_limit_blocks_at_limit():
+    limit = AdaptiveLimit(initial=1, minimum=1, maximum=1, latency_target=0)
+    assert limit.acquire(0)
+    assert not limit.try_acquire()
+    assert not limit.acquire(0.05)
+    limit.release(0.01)
+    assert limit.try_acquire()
+
+
+def test_retries_transient_errors_only():
+    upstream = Upstream('t', max_retries=2, backoff_base=0.001, breaker_threshold=0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise StatusError(429)
+        return 'ok'
+
+    assert upstream.call(flaky) == 'ok'
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(StatusError):
+        upstream.call(lambda: calls.append(1) or failing(400)())
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(StatusError):
+        upstream.call(lambda: calls.append(1) or failing(503)())
+    assert len(calls) == 3
+
+
+def test_hedge_returns_faster_copy():
+    upstream = Upstream('t', max_concurrency=4, hedge_percentile=50, hedge_min_samples=5)
+    for _ in range(5):
+        upstream.call(lambda: time.sleep(0.01))
+
+    lock = threading.Lock()
+    started = []
+
+    def slow_first():
+        with lock:
+            started.append(1)
+            first = len(started) == 1
+        if first:
+            time.sleep(1.0)
+            return 'primary'
+        return 'hedge'
+
+    start = time.perf_counter()
+    assert upstream.call(slow_first) == 'hedge'
+    assert time.perf_counter() - start < 0.5
+    assert len(started) == 2
+
+
+def test_no_hedge_when_disabled_for_call():
+    upstream = Upstream('t', max_concurrency=4, hedge_percentile=50, hedge_min_samples=1)
+    upstream.call(lambda: None)
+    calls = []
+    upstream.call(lambda: calls.append(1) or time.sleep(0.05), hedge=False)
+    assert len(calls) == 1